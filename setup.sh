@@ -13,7 +13,14 @@ fi
 if [ ! -d "$outdir/doclen/" ]; then
     mkdir -p $outdir/doclen
 fi
+if [ ! -d "$outdir/docs/" ]; then
+    mkdir -p $outdir/docs
+fi
 
-python src/create_inverted_index.py $docdir $outdir/index/${dtype}.index
-python src/create_bg_lm.py $docdir $outdir/bglm/${dtype}.bglm
-python src/calc_doc_len.py $docdir $outdir/doclen/${dtype}.doclen
+# one pass over the corpus writes the index, background LM, doc lengths and
+# document store together
+python src/build_corpus.py --binary-index=$outdir/index/${dtype}.index.bin \
+                           $docdir $outdir/index/${dtype}.index \
+                           $outdir/bglm/${dtype}.bglm \
+                           $outdir/doclen/${dtype}.doclen \
+                           $outdir/docs/${dtype}.docs
@@ -0,0 +1,53 @@
+# File name: batch_retrieve.py
+# python version: 3.5+
+# Description:
+#   Precompute the rankings of a whole query file in batches.
+"""batch_retrieve.py
+
+Usage:
+    batch_retrieve.py [options] <ptv-query> <inv-index> <output>
+    batch_retrieve.py -h
+
+Options:
+    -h --help               : show help message
+    --doc-len=<file>        : doclen pickle of a pickled index
+    --bg-lm=<file>          : bglm pickle of a pickled index
+    --top-k=<k>             : ranking length per query [default: 1000]
+    --batch-size=<n>        : number of queries scored at once [default: 64]
+    --mu=<mu>               : Dirichlet prior parameter [default: 1000]
+
+<inv-index> is a binary index, a segmented index directory or a pickled
+index; only the last needs the doclen and bglm pickles. Each batch holds a
+float64 score and a bool match flag for every query and document, about
+9 * <n> * D bytes for D documents, e.g. 576MB for 64 queries over a
+million documents.
+
+Each output line holds a query followed by its ranked documents, in the
+same format as PTV.ans.
+"""
+from docopt import docopt
+from util import read_queries
+from util import is_array_bundle
+from scoring import LangScorer
+from scoring import load_index
+from segment_index import is_segmented_index
+
+def main(docopt_args):
+    queries = read_queries(docopt_args['<ptv-query>'])
+    index_file = docopt_args['<inv-index>']
+    if not (is_array_bundle(index_file) or is_segmented_index(index_file)) \
+            and not (docopt_args['--doc-len'] and docopt_args['--bg-lm']):
+        raise ValueError('a pickled index needs --doc-len and --bg-lm')
+    index = load_index(index_file, docopt_args['--doc-len'],
+                       docopt_args['--bg-lm'])
+    scorer = LangScorer(index, mu=float(docopt_args['--mu']))
+    rankings = scorer.batch_top_k([scorer.query_terms(q) for q in queries],
+                                  int(docopt_args['--top-k']),
+                                  int(docopt_args['--batch-size']))
+    with open(docopt_args['<output>'], 'w') as fout:
+        for q, (doc_ids, _) in zip(queries, rankings):
+            fout.write('{0} {1}\n'.format(''.join(q), ' '.join(
+                index.doc_names[doc_id] for doc_id in doc_ids)))
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
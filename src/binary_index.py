@@ -0,0 +1,410 @@
+# File name: binary_index.py
+# python version: 3.5+
+# Description:
+#   Memory-mapped binary inverted index, replacing the pickled index,
+#   doclen and bglm dicts.
+'''Binary inverted index
+
+The index is one array bundle (see util.create_arrays) with the attributes
+{"format": "iir-index", "version": 1} and these arrays:
+
+  vocab      <U*     (T,)    sorted chars and bichars, term ID = position
+  offsets    int64   (T+1,)  postings of term t are [offsets[t], offsets[t+1])
+  doc_ids    int32   (P,)    posting doc IDs, ascending within each term
+  tfs        int32   (P,)    posting term frequencies
+  bglm       float64 (T,)    background language model probability
+  max_tf     int32   (T,)    largest tf in the posting list
+  min_tf     int32   (T,)    smallest tf in the posting list
+  min_len    float64 (T,)    shortest document in the posting list
+  max_len    float64 (T,)    longest document in the posting list
+  doc_names  <U*     (D,)    sorted document file names, doc ID = position
+  doclen     float64 (D,)    document lengths in characters
+
+Opening the index only maps the file. Terms are found by binary search in
+"vocab", so no Python object is built per term or per posting, and all
+processes that open the same file share its pages.
+
+Compressed postings
+-------------------
+With the attributes {"postings": "varbyte", "block_size": S}, "doc_ids"
+and "tfs" are replaced by variable-byte coded blocks of S postings:
+
+  term_blocks   int64 (T+1,)  blocks of term t are
+                              [term_blocks[t], term_blocks[t+1])
+  block_offsets int64 (B+1,)  bytes of block b are
+                              [block_offsets[b], block_offsets[b+1])
+  block_last    int32 (B,)    last doc ID of each block
+  data          uint8 (N,)    all blocks
+
+A block holds the doc-ID gaps of its postings followed by their tfs. Gaps
+are taken from the previous posting of the same term, and from 0 for the
+first one, so a block is decoded on its own from the "block_last" of the
+block before it. Values take 7 bits per byte, low bits first, and a set
+high bit means that more bytes follow. Dense posting lists then cost about
+two bytes per posting instead of eight, and any set of blocks is decoded
+with a few vectorized NumPy operations.
+
+Impacts
+-------
+With the attribute {"impact_mu": mu}, the index also stores the score
+log2((mu + tf / bglm) / (mu + doclen)) of every posting for that mu, so
+scoring is only weighted additions:
+
+  impacts     float64 (P,)   impact of each posting
+  impact_min  float64 (T,)   smallest impact of each term
+  impact_max  float64 (T,)   largest impact of each term
+
+With {"impact_bits": 8 or 16} as well, "impacts" is quantized to uint8 or
+uint16 levels between the two bounds, and
+
+  impact_step float64 (T,)   impact of one level, impact = min + q * step
+'''
+import numpy as np
+from util import load_arrays
+from util import save_arrays
+
+INDEX_FORMAT = 'iir-index'
+INDEX_VERSION = 1
+VARBYTE = 'varbyte'
+
+class BinaryIndex:
+    '''Index view over a memory-mapped binary index, as DictIndex'''
+    def __init__(self, filename):
+        arrays, attrs = load_arrays(filename)
+        if attrs.get('format') != INDEX_FORMAT or \
+                attrs.get('version') != INDEX_VERSION:
+            raise ValueError('{0} is not a version {1} binary index'.format(
+                             filename, INDEX_VERSION))
+        self.arrays = arrays
+        self.vocab = arrays['vocab']
+        self.offsets = arrays['offsets']
+        self.doc_names = arrays['doc_names'].tolist()
+        self.doclen = arrays['doclen']
+        self.num_docs = len(self.doc_names)
+        self.term_ids = {}
+        # None for plain "doc_ids" and "tfs" arrays
+        self.block_size = attrs['block_size'] \
+            if attrs.get('postings') == VARBYTE else None
+        # mu of the stored impacts, None without impacts
+        self.impact_mu = attrs.get('impact_mu')
+
+    def term_id(self, token):
+        '''Return the term ID of "token", or -1 if it is not indexed'''
+        if token not in self.term_ids:
+            pos = int(np.searchsorted(self.vocab, token))
+            found = pos < len(self.vocab) and self.vocab[pos] == token
+            self.term_ids[token] = pos if found else -1
+        return self.term_ids[token]
+
+    def __contains__(self, token):
+        return self.term_id(token) >= 0
+
+    def postings(self, token):
+        '''Return (doc_ids, tfs) of "token", sorted by doc ID'''
+        term = self.term_id(token)
+        if self.block_size is not None:
+            term_blocks = self.arrays['term_blocks']
+            return self.decode_blocks(np.arange(term_blocks[term],
+                                                term_blocks[term + 1]))
+        start, end = self.offsets[term], self.offsets[term + 1]
+        return (self.arrays['doc_ids'][start:end],
+                self.arrays['tfs'][start:end])
+
+    def postings_at(self, token, doc_ids):
+        '''
+        Return (doc_ids, tfs) of "token" at the sorted "doc_ids" it occurs
+        in. Compressed postings only decode the blocks that may hold them.
+        '''
+        if self.block_size is None:
+            return find_postings(*self.postings(token), doc_ids=doc_ids)
+        return find_postings(*self.decode_blocks(self.__blocks_at(
+            self.term_id(token), doc_ids)), doc_ids=doc_ids)
+
+    def impacts(self, token):
+        '''Return (doc_ids, impacts) of "token", for mu = impact_mu'''
+        term = self.term_id(token)
+        doc_ids, _ = self.postings(token)
+        return doc_ids, self.__dequantize(term, self.arrays['impacts'][
+            self.offsets[term]:self.offsets[term + 1]])
+
+    def impacts_at(self, token, doc_ids):
+        '''Return (doc_ids, impacts) of "token" at the sorted "doc_ids"'''
+        term = self.term_id(token)
+        if self.block_size is None:
+            start, end = self.offsets[term], self.offsets[term + 1]
+            posting_ids = self.arrays['doc_ids'][start:end]
+            positions = np.arange(start, end)
+        else:
+            blocks = self.__blocks_at(term, doc_ids)
+            posting_ids, _ = self.decode_blocks(blocks)
+            positions = segment_ranges(*self.__block_postings(blocks)[1:])
+        doc_ids, positions = find_postings(posting_ids, positions, doc_ids)
+        return doc_ids, self.__dequantize(term,
+                                          self.arrays['impacts'][positions])
+
+    def impact_bounds(self, token):
+        '''Return the (largest, smallest) impact of "token"'''
+        term = self.term_id(token)
+        return self.arrays['impact_max'][term], self.arrays['impact_min'][term]
+
+    def __dequantize(self, term, impacts):
+        if 'impact_step' not in self.arrays:
+            return impacts
+        return self.arrays['impact_min'][term] + \
+            self.arrays['impact_step'][term] * impacts
+
+    def __blocks_at(self, term, doc_ids):
+        '''Return the blocks of "term" that may hold the sorted "doc_ids"'''
+        first, last = self.arrays['term_blocks'][term:term + 2]
+        blocks = np.unique(np.searchsorted(
+            self.arrays['block_last'][first:last], doc_ids))
+        return blocks[blocks < last - first] + first
+
+    def __block_postings(self, blocks):
+        '''
+        Return the block number within its term, the first posting and the
+        number of postings of each compressed block in "blocks"
+        '''
+        term_blocks = self.arrays['term_blocks']
+        terms = np.searchsorted(term_blocks, blocks, side='right') - 1
+        rel = blocks - term_blocks[terms]
+        starts = self.offsets[terms] + self.block_size * rel
+        counts = np.minimum(starts + self.block_size,
+                            self.offsets[terms + 1]) - starts
+        return rel, starts, counts
+
+    def all_postings(self):
+        '''Return (doc_ids, tfs) of all terms, ordered as "offsets"'''
+        if self.block_size is not None:
+            return self.decode_blocks(np.arange(len(
+                self.arrays['block_last'])))
+        return self.arrays['doc_ids'], self.arrays['tfs']
+
+    def decode_blocks(self, blocks):
+        '''Return the (doc_ids, tfs) of the sorted compressed "blocks"'''
+        arrays = self.arrays
+        block_offsets = arrays['block_offsets']
+        rel, _, counts = self.__block_postings(blocks)
+        # gather the bytes of the blocks
+        byte_starts = block_offsets[blocks]
+        byte_counts = block_offsets[blocks + 1] - byte_starts
+        if len(blocks) and blocks[-1] - blocks[0] == len(blocks) - 1:
+            data = arrays['data'][byte_starts[0]:block_offsets[blocks[-1]
+                                                               + 1]]
+        else:
+            data = arrays['data'][segment_ranges(byte_starts, byte_counts)]
+        values = varbyte_decode(data)
+        # each block is [gaps, tfs]
+        firsts = np.cumsum(counts) - counts
+        block_of = np.repeat(np.arange(len(blocks)), counts)
+        pos = np.arange(len(block_of)) + firsts[block_of]
+        gaps = values[pos]
+        tfs = values[pos + counts[block_of]].astype(np.int32)
+        # doc IDs restart from the last doc ID of the block before
+        cumsum = np.cumsum(gaps)
+        bases = np.where(rel > 0, arrays['block_last'][blocks - 1], 0) - \
+            (cumsum[firsts] - gaps[firsts])
+        doc_ids = (cumsum + bases[block_of]).astype(np.int32)
+        return doc_ids, tfs
+
+    def stats(self, token):
+        '''Return (max_tf, min_tf, min_doclen, max_doclen) of "token"'''
+        term = self.term_id(token)
+        return tuple(self.arrays[name][term] for name in
+                     ('max_tf', 'min_tf', 'min_len', 'max_len'))
+
+    def bglm(self, token):
+        '''Background probability of "token"'''
+        return self.arrays['bglm'][self.term_id(token)]
+
+    def doc_id(self, doc):
+        '''Return the doc ID of file name "doc"'''
+        return int(np.searchsorted(self.arrays['doc_names'], doc))
+
+def write_binary_index(filename, index_dict, doclen_dict, bglm_dict,
+                       block_size=None, impact_mu=None, impact_bits=None):
+    '''
+    Convert the pickled index, doclen and bglm dicts to a binary index.
+    See save_binary_index for the options.
+    '''
+    save_binary_index(filename, dict_arrays(index_dict, doclen_dict,
+                                            bglm_dict),
+                      block_size, impact_mu, impact_bits)
+
+def dict_arrays(index_dict, doclen_dict, bglm_dict):
+    '''Return the posting_arrays of the index, doclen and bglm dicts'''
+    vocab = sorted(index_dict)
+    doc_names = sorted(doclen_dict)
+    doc2id = {doc: ind for ind, doc in enumerate(doc_names)}
+    doclen = np.array([doclen_dict[doc] for doc in doc_names],
+                      dtype=np.float64)
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(index_dict[t]['docs']) for t in vocab])
+    doc_ids = np.zeros(offsets[-1], dtype=np.int32)
+    tfs = np.zeros(offsets[-1], dtype=np.int32)
+    for term, token in enumerate(vocab):
+        docs = index_dict[token]['docs']
+        ids = np.array([doc2id[doc] for doc in docs], dtype=np.int32)
+        order = np.argsort(ids, kind='stable')
+        doc_ids[offsets[term]:offsets[term + 1]] = ids[order]
+        tfs[offsets[term]:offsets[term + 1]] = \
+            np.fromiter(docs.values(), dtype=np.int32, count=len(docs))[order]
+    bglm = np.array([bglm_dict[token] for token in vocab], dtype=np.float64)
+    return posting_arrays(vocab, offsets, doc_ids, tfs, bglm, doc_names,
+                          doclen)
+
+def save_binary_index(filename, arrays, block_size=None, impact_mu=None,
+                      impact_bits=None):
+    '''
+    Write the arrays of posting_arrays as a binary index.
+
+    Args:
+      filename: output file name
+      arrays: dict of arrays from posting_arrays
+      block_size(default=None): compress postings in blocks of this size
+      impact_mu(default=None): store the posting impacts for this mu
+      impact_bits(default=None): quantize the impacts to 8 or 16 bits
+    '''
+    attrs = {'format': INDEX_FORMAT, 'version': INDEX_VERSION}
+    if impact_mu is not None:
+        arrays = dict(arrays)
+        arrays.update(impact_arrays(arrays, impact_mu, impact_bits))
+        attrs['impact_mu'] = impact_mu
+        if impact_bits:
+            attrs['impact_bits'] = impact_bits
+    if block_size:
+        arrays = dict(arrays)
+        arrays.update(compress_postings(arrays['offsets'],
+                                        arrays.pop('doc_ids'),
+                                        arrays.pop('tfs'), block_size))
+        attrs.update(postings=VARBYTE, block_size=block_size)
+    save_arrays(filename, arrays, attrs)
+
+def reduce_postings(ufunc, values, offsets, empty):
+    '''Reduce "values" over each posting list, "empty" for empty ones'''
+    starts = offsets[:-1]
+    nonempty = offsets[1:] > starts
+    out = np.full(len(starts), empty, dtype=values.dtype)
+    if len(values):
+        out[nonempty] = ufunc.reduceat(values, starts[nonempty])
+    return out
+
+def posting_arrays(vocab, offsets, doc_ids, tfs, bglm, doc_names, doclen):
+    '''Return the dict of binary index arrays, adding per-term statistics'''
+    def reduce_at(ufunc, values, empty):
+        return reduce_postings(ufunc, values, offsets, empty)
+    posting_len = doclen[doc_ids]
+    return {'vocab': np.array(vocab, dtype=np.str_),
+            'offsets': offsets,
+            'doc_ids': doc_ids,
+            'tfs': tfs,
+            'bglm': bglm,
+            'max_tf': reduce_at(np.maximum, tfs, 0),
+            'min_tf': reduce_at(np.minimum, tfs, 0),
+            'min_len': reduce_at(np.minimum, posting_len, 0.0),
+            'max_len': reduce_at(np.maximum, posting_len, 0.0),
+            'doc_names': np.array(doc_names, dtype=np.str_),
+            'doclen': doclen}
+
+def find_postings(posting_ids, tfs, doc_ids):
+    '''Return the (doc_ids, tfs) of one posting list at sorted "doc_ids"'''
+    if len(posting_ids) == 0:
+        return doc_ids[:0], tfs
+    pos = np.searchsorted(posting_ids, doc_ids)
+    pos[pos == len(posting_ids)] = 0
+    hit = posting_ids[pos] == doc_ids
+    return doc_ids[hit], tfs[pos[hit]]
+
+def segment_ranges(starts, counts):
+    '''Concatenate the ranges [starts[i], starts[i] + counts[i])'''
+    ends = np.cumsum(counts)
+    return np.arange(ends[-1] if len(ends) else 0) + \
+        np.repeat(starts - (ends - counts), counts)
+
+def varbyte_lengths(values):
+    '''Return the number of bytes of each value in variable-byte code'''
+    lengths = np.ones(len(values), dtype=np.int64)
+    for shift in (7, 14, 21, 28):
+        lengths += values >= (1 << shift)
+    return lengths
+
+def varbyte_encode(values):
+    '''Encode non-negative integers below 2**35 in variable-byte code'''
+    values = np.asarray(values, dtype=np.int64)
+    lengths = varbyte_lengths(values)
+    starts = np.cumsum(lengths) - lengths
+    data = np.zeros(int(lengths.sum()), dtype=np.uint8)
+    for byte in range(5):
+        has = lengths > byte
+        more = (lengths[has] > byte + 1).astype(np.int64) << 7
+        data[starts[has] + byte] = (values[has] >> (7 * byte)) & 127 | more
+    return data
+
+def varbyte_decode(data):
+    '''Decode a variable-byte code into an int64 array'''
+    if len(data) == 0:
+        return np.zeros(0, dtype=np.int64)
+    last = data < 128
+    starts = np.flatnonzero(np.concatenate(([True], last[:-1])))
+    value_of = np.cumsum(last) - last
+    shifts = 7 * (np.arange(len(data)) - starts[value_of])
+    return np.add.reduceat((data & 127).astype(np.int64) << shifts, starts)
+
+def compress_postings(offsets, doc_ids, tfs, block_size):
+    '''Return the compressed posting arrays described in the docstring'''
+    counts = np.diff(offsets)
+    term_blocks = np.zeros(len(counts) + 1, dtype=np.int64)
+    term_blocks[1:] = np.cumsum(-(-counts // block_size))
+    terms = np.repeat(np.arange(len(counts)), np.diff(term_blocks))
+    starts = offsets[terms] + \
+        block_size * (np.arange(len(terms)) - term_blocks[terms])
+    ends = np.minimum(starts + block_size, offsets[terms + 1])
+    gaps = doc_ids.astype(np.int64)
+    gaps[1:] -= doc_ids[:-1]
+    term_starts = offsets[:-1][counts > 0]
+    gaps[term_starts] = doc_ids[term_starts]
+    # lay out every block as its gaps followed by its tfs
+    block_of = np.repeat(np.arange(len(terms)), ends - starts)
+    pos = np.arange(len(doc_ids)) + starts[block_of]
+    values = np.zeros(2 * len(doc_ids), dtype=np.int64)
+    values[pos] = gaps
+    values[pos + (ends - starts)[block_of]] = tfs
+    value_ends = np.zeros(len(values) + 1, dtype=np.int64)
+    value_ends[1:] = np.cumsum(varbyte_lengths(values))
+    block_offsets = np.append(value_ends[2 * starts], value_ends[-1])
+    return {'term_blocks': term_blocks,
+            'block_offsets': block_offsets,
+            'block_last': doc_ids[ends - 1].astype(np.int32),
+            'data': varbyte_encode(values)}
+
+def impact_arrays(arrays, mu, bits=None):
+    '''
+    Return the impact arrays of the posting_arrays "arrays" for "mu",
+    quantized to "bits" bits if it is given.
+    '''
+    offsets = arrays['offsets']
+    bglm = np.repeat(arrays['bglm'], np.diff(offsets))
+    # the same expression as LangScorer.term_scores, so the scores match
+    impacts = np.log2((mu + arrays['tfs'] / bglm) /
+                      (mu + arrays['doclen'][arrays['doc_ids']]))
+    impact_min = reduce_postings(np.minimum, impacts, offsets, 0.0)
+    impact_max = reduce_postings(np.maximum, impacts, offsets, 0.0)
+    if not bits:
+        return {'impacts': impacts, 'impact_min': impact_min,
+                'impact_max': impact_max}
+    if bits not in (8, 16):
+        raise ValueError('impacts are quantized to 8 or 16 bits, '
+                         'not {0}'.format(bits))
+    levels = 2**bits - 1
+    impact_step = (impact_max - impact_min) / levels
+    step = np.repeat(impact_step, np.diff(offsets))
+    low = np.repeat(impact_min, np.diff(offsets))
+    quantized = np.zeros(len(impacts))
+    varied = step > 0
+    quantized[varied] = np.rint((impacts[varied] - low[varied]) /
+                                step[varied])
+    return {'impacts': quantized.astype(np.uint8 if bits == 8
+                                        else np.uint16),
+            'impact_min': impact_min,
+            'impact_max': impact_max,
+            'impact_step': impact_step}
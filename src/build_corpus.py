@@ -0,0 +1,127 @@
+# File name: build_corpus.py
+# python version: 3.5+
+# Description:
+#   Read the corpus once and write the inverted index, background language
+#   model, document lengths and document store from the same counts.
+"""build_corpus.py
+
+Usage:
+    build_corpus.py [options] <corpus_dir> <inv_index_output> <bg_lm_output>
+                    <doclen_output> <doc_store_output>
+    build_corpus.py -h
+
+Options:
+    -h --help               : show help message
+    --workers=<n>           : number of worker processes [default: 1]
+    --binary-index=<file>   : also write the binary index to <file>
+    --block-size=<n>        : compress its postings in blocks of <n>
+    --impact-mu=<mu>        : store its posting scores for Dirichlet <mu>
+    --impact-bits=<b>       : quantize those scores to <b> = 8 or 16 bits
+
+The outputs equal those of create_inverted_index.py, create_bg_lm.py,
+calc_doc_len.py and create_doc_store.py, which each read the corpus again.
+"""
+import pickle
+from collections import Counter
+from multiprocessing import Pool
+from docopt import docopt
+from util import walk_all_files
+from create_inverted_index import add_doc_index
+from create_inverted_index import count_text_tokens
+from create_inverted_index import merge_index
+from create_inverted_index import shard_files
+from doc_store import pack_doc_store
+from doc_store import save_doc_store
+from binary_index import write_binary_index
+from convert_index import index_options
+
+def scan_doc(filepath):
+    '''
+    Read one document and return its token counts, its length in chars
+    and its words.
+    '''
+    counts = Counter()
+    doclen = 0
+    words = []
+    with open(filepath) as f:
+        for line in f:
+            line_words = line.strip().split()
+            text = ''.join(line_words)
+            count_text_tokens(counts, text)
+            doclen += len(text)
+            words.extend(line_words)
+    return counts, doclen, words
+
+def scan_files(files):
+    '''
+    Scan a list of (filename, filepath).
+
+    Returns:
+      index_dict: inverted index of the files
+      len_dict: file name to document length dict
+      words_dict: file name to word list dict
+    '''
+    index_dict = dict()
+    len_dict = dict()
+    words_dict = dict()
+    for filename, filepath in files:
+        counts, len_dict[filename], words_dict[filename] = scan_doc(filepath)
+        add_doc_index(index_dict, counts, filename)
+    for entry in index_dict.values():
+        entry['df'] = len(entry['docs'])
+    return index_dict, len_dict, words_dict
+
+def background_lm(index_dict):
+    '''
+    Return the background language model of an index: chars are normalized
+    by the total char count and bichars by the total bichar count.
+    '''
+    lm_dict = dict()
+    for size in (1, 2):
+        totals = {token: entry['total'] for token, entry in
+                  index_dict.items() if len(token) == size}
+        total = sum(totals.values())
+        for token, count in totals.items():
+            lm_dict[token] = count / total
+    return lm_dict
+
+def build_corpus(corpus_dir, workers=1):
+    '''
+    Scan "corpus_dir" once, split across "workers" processes.
+
+    Returns:
+      index_dict, bglm_dict, len_dict: the index, background LM and
+        document length dicts
+      doc_arrays: the document store arrays
+    '''
+    files = list(walk_all_files(corpus_dir))
+    if workers <= 1 or len(files) < 2:
+        parts = [scan_files(files)]
+    else:
+        with Pool(workers) as pool:
+            parts = list(pool.imap(scan_files,
+                                   shard_files(files, 4 * workers)))
+    index_dict = merge_index(part[0] for part in parts)
+    len_dict = dict()
+    words_dict = dict()
+    for _, part_len, part_words in parts:
+        len_dict.update(part_len)
+        words_dict.update(part_words)
+    return (index_dict, background_lm(index_dict), len_dict,
+            pack_doc_store(words_dict))
+
+def main(docopt_args):
+    index_dict, bglm_dict, len_dict, doc_arrays = build_corpus(
+        docopt_args['<corpus_dir>'], int(docopt_args['--workers']))
+    for dict_obj, output in ((index_dict, '<inv_index_output>'),
+                             (bglm_dict, '<bg_lm_output>'),
+                             (len_dict, '<doclen_output>')):
+        with open(docopt_args[output], 'wb') as fout:
+            pickle.dump(dict_obj, fout)
+    save_doc_store(docopt_args['<doc_store_output>'], doc_arrays)
+    if docopt_args['--binary-index']:
+        write_binary_index(docopt_args['--binary-index'], index_dict,
+                           len_dict, bglm_dict, **index_options(docopt_args))
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
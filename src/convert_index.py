@@ -0,0 +1,38 @@
+# File name: convert_index.py
+# python version: 3.5+
+# Description:
+#   Convert the pickled index, doclen and bglm to one binary index.
+"""convert_index.py
+
+Usage:
+    convert_index.py [options] <inv-index> <doc-len> <bg-lm>
+                     <binary-index-output>
+    convert_index.py -h
+
+Options:
+    -h --help           : show help message
+    --block-size=<n>    : compress postings in blocks of <n> postings
+    --impact-mu=<mu>    : precompute the posting scores for Dirichlet <mu>
+    --impact-bits=<b>   : quantize those scores to <b> = 8 or 16 bits
+"""
+from docopt import docopt
+from util import pickle_load
+from binary_index import write_binary_index
+
+def main(docopt_args):
+    write_binary_index(docopt_args['<binary-index-output>'],
+                       pickle_load(docopt_args['<inv-index>']),
+                       pickle_load(docopt_args['<doc-len>']),
+                       pickle_load(docopt_args['<bg-lm>']),
+                       **index_options(docopt_args))
+
+def index_options(docopt_args):
+    '''Return the keyword arguments of write_binary_index'''
+    def optional(convert, option):
+        return convert(docopt_args[option]) if docopt_args[option] else None
+    return {'block_size': optional(int, '--block-size'),
+            'impact_mu': optional(float, '--impact-mu'),
+            'impact_bits': optional(int, '--impact-bits')}
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -0,0 +1,22 @@
+# File name: create_doc_store.py
+# python version: 3.5+
+# Description:
+#   Pack a document directory into one document store file.
+"""create_doc_store.py
+
+Usage:
+    create_doc_store.py <corpus_dir> <doc_store_output>
+    create_doc_store.py -h
+
+Options:
+    -h --help       : show help message
+"""
+from docopt import docopt
+from doc_store import write_doc_store
+
+def main(docopt_args):
+    write_doc_store(docopt_args['<doc_store_output>'],
+                    docopt_args['<corpus_dir>'])
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -1,55 +1,102 @@
 # File name: create_inverted_index.py
 # Author: Yang-de Chen
 # Date created: 12/14/2016
-# Date modified: 12/18/2016
+# Date modified: 10/18/2026
 # python version: 3.5+
 # Description:
 #   Run interactive retrieval experiment.
 """create_inverted_index.py
-    
+
 Usage:
-    create_inverted_index.py <corpus_dir> <inv_index_output>
+    create_inverted_index.py [options] <corpus_dir> <inv_index_output>
     create_inverted_index.py -h
+
 Options:
-    -h --help       : show help message
+    -h --help           : show help message
+    --workers=<n>       : number of worker processes [default: 1]
 """
 import sys
 import pickle
+from collections import Counter
+from multiprocessing import Pool
+from operator import add
 from util import walk_all_files
 from docopt import docopt
 
 # index format: token: [total, docs: (file, tf), df]
-index_dict = dict()
-
-def add_token_index(token, filename):
-    if token not in index_dict:
-        index_dict[token] = {}
-        index_dict[token]['total'] = 0
-        index_dict[token]['docs'] = {}
-        index_dict[token]['df'] = 0
-    index_dict[token]['total'] += 1
-    # store document term freq.
-    index_dict[token]['docs'][filename] = \
-        index_dict[token]['docs'].get(filename, 0) + 1
-    index_dict[token]['df'] = len(index_dict[token]['docs'].keys())
-
-def add_char_index(text, filename):
-    for ch in text:
-        add_token_index(ch, filename)
-
-def add_bichar_index(text, filename):
-    for i in range(1, len(text)):
-        bichar = text[i-1] + text[i]
-        add_token_index(bichar, filename)
+
+def count_text_tokens(counts, text):
+    '''Add the chars, then the bichars, of one line "text" to "counts"'''
+    counts.update(text)
+    counts.update(map(add, text, text[1:]))
+
+def count_doc_tokens(filepath):
+    '''
+    Count the chars and bichars of one document. Tokens keep the order in
+    which they first appear, line by line, chars before bichars.
+    '''
+    counts = Counter()
+    with open(filepath) as f:
+        for line in f:
+            count_text_tokens(counts, ''.join(line.strip().split()))
+    return counts
+
+def add_doc_index(index_dict, counts, filename):
+    '''Add the token counts of one document to "index_dict"'''
+    for token, tf in counts.items():
+        if token not in index_dict:
+            index_dict[token] = {}
+            index_dict[token]['total'] = 0
+            index_dict[token]['docs'] = {}
+            index_dict[token]['df'] = 0
+        index_dict[token]['total'] += tf
+        # store document term freq.
+        index_dict[token]['docs'][filename] = tf
+
+def index_files(files):
+    '''Build the index of a list of (filename, filepath)'''
+    index_dict = dict()
+    for filename, filepath in files:
+        add_doc_index(index_dict, count_doc_tokens(filepath), filename)
+    for entry in index_dict.values():
+        entry['df'] = len(entry['docs'])
+    return index_dict
+
+def merge_index(index_dicts):
+    '''
+    Merge partial indexes of consecutive shards, in shard order, so the
+    result equals the index of all the files built in one pass.
+    '''
+    index_dict = dict()
+    for partial in index_dicts:
+        for token, entry in partial.items():
+            if token not in index_dict:
+                index_dict[token] = entry
+            else:
+                index_dict[token]['total'] += entry['total']
+                index_dict[token]['docs'].update(entry['docs'])
+    for entry in index_dict.values():
+        entry['df'] = len(entry['docs'])
+    return index_dict
+
+def shard_files(files, num_shards):
+    '''Split "files" into "num_shards" consecutive shards'''
+    size = -(-len(files) // num_shards)
+    return [files[i:i + size] for i in range(0, len(files), size)]
+
+def build_index(corpus_dir, workers=1):
+    '''Index "corpus_dir", split across "workers" processes'''
+    files = list(walk_all_files(corpus_dir))
+    if workers <= 1 or len(files) < 2:
+        return index_files(files)
+    # a few shards per worker evens out documents of different lengths
+    shards = shard_files(files, 4 * workers)
+    with Pool(workers) as pool:
+        return merge_index(pool.imap(index_files, shards))
 
 def main(docopt_args):
-    all_files = walk_all_files(docopt_args['<corpus_dir>'])
-    for filename, filepath in all_files:
-        with open(filepath) as f:
-            for line in f:
-                text = ''.join(line.strip().split())
-                add_char_index(text, filename)
-                add_bichar_index(text, filename)
+    index_dict = build_index(docopt_args['<corpus_dir>'],
+                             int(docopt_args['--workers']))
     with open(docopt_args['<inv_index_output>'], 'wb') as fout:
         pickle.dump(index_dict, fout)
 
@@ -0,0 +1,35 @@
+# File name: create_keyword_store.py
+# python version: 3.5+
+# Description:
+#   Compile a keyterm directory into one keyword store file.
+"""create_keyword_store.py
+
+Usage:
+    create_keyword_store.py [options] <keyword_dir> <keyword_store_output>
+    create_keyword_store.py -h
+
+Options:
+    -h --help               : show help message
+    --scores=<dtype>        : score dtype, float32 or float64
+                              [default: float32]
+    --max-keywords=<n>      : keep only the top <n> keywords per document
+
+float32 scores halve the store, but round scores to about 7 digits, which
+may reorder keywords whose scores only differ beyond that. Use float64 to
+keep the scores of the keyterm files exactly.
+"""
+import numpy as np
+from docopt import docopt
+from keyword_store import write_keyword_store
+
+def main(docopt_args):
+    if docopt_args['--scores'] not in ('float32', 'float64'):
+        raise ValueError('--scores must be float32 or float64')
+    max_keywords = docopt_args['--max-keywords']
+    write_keyword_store(docopt_args['<keyword_store_output>'],
+                        docopt_args['<keyword_dir>'],
+                        np.dtype(docopt_args['--scores']),
+                        int(max_keywords) if max_keywords else None)
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
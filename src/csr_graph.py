@@ -0,0 +1,180 @@
+# File name: csr_graph.py
+# python version: 3.5+
+# Description:
+#   Undirected weighted graph in compressed sparse row arrays, for the
+#   node2vec walks of extract_joint_features_efficient.py.
+'''Compressed sparse row graph
+
+An undirected weighted graph with N nodes is kept as three arrays:
+
+  indptr   int64   (N+1,)  neighbors of node u are
+                           indices[indptr[u]:indptr[u+1]]
+  indices  int32   (2E,)   neighbor node IDs, sorted within each node
+  weights  float32 (2E,)   edge weights, aligned with indices
+
+Every undirected edge is stored in both directions, and parallel edges are
+merged into one edge that carries their summed weight.
+
+First-order alias tables are kept flat and aligned with indices, so the
+table of node u is alias[indptr[u]:indptr[u+1]], prob[indptr[u]:indptr[u+1]]
+with alias positions relative to indptr[u]. With them, batch_walks moves
+thousands of walkers one step at a time with array-wide draws.
+'''
+import numpy as np
+from util import alias_setup
+
+class CSRGraph:
+    '''Undirected weighted graph in CSR arrays'''
+    def __init__(self, indptr, indices, weights):
+        self.indptr = indptr
+        self.indices = indices
+        self.weights = weights
+        self.num_nodes = len(indptr) - 1
+        # sorted u * num_nodes + v of every directed edge, built on demand
+        self.edge_keys = None
+
+    def degree(self):
+        '''Return the number of distinct neighbors of every node'''
+        return np.diff(self.indptr)
+
+    def neighbors(self, node):
+        '''Return the sorted neighbors of "node"'''
+        return self.indices[self.indptr[node]:self.indptr[node + 1]]
+
+    def edge_weights(self, node):
+        '''Return the edge weights of "node", aligned with its neighbors'''
+        return self.weights[self.indptr[node]:self.indptr[node + 1]]
+
+    def has_edge(self, node, other):
+        '''Return whether "node" has an edge to "other"'''
+        nbrs = self.neighbors(node)
+        pos = int(np.searchsorted(nbrs, other))
+        return pos < len(nbrs) and nbrs[pos] == other
+
+    def has_edges(self, node, others):
+        '''Return whether "node" has an edge to each node of "others"'''
+        nbrs = self.neighbors(node)
+        if len(nbrs) == 0:
+            return np.zeros(len(others), dtype=bool)
+        pos = np.searchsorted(nbrs, others)
+        pos[pos == len(nbrs)] = 0
+        return nbrs[pos] == others
+
+    def has_edge_pairs(self, nodes, others):
+        '''Return whether nodes[i] has an edge to others[i], for every i'''
+        if self.edge_keys is None:
+            self.edge_keys = np.repeat(
+                np.arange(self.num_nodes, dtype=np.int64),
+                self.degree()) * self.num_nodes + self.indices
+        if len(self.edge_keys) == 0:
+            return np.zeros(len(nodes), dtype=bool)
+        keys = np.asarray(nodes, dtype=np.int64) * self.num_nodes + others
+        # sorted keys make the binary searches walk the edges in order
+        order = np.argsort(keys)
+        pos = np.zeros(len(keys), dtype=np.int64)
+        pos[order] = np.searchsorted(self.edge_keys, keys[order])
+        pos[pos == len(self.edge_keys)] = 0
+        return self.edge_keys[pos] == keys
+
+def csr_graph(num_nodes, src, dst, weight):
+    '''
+    Build a CSRGraph from undirected edges.
+
+    Args:
+      num_nodes: number of nodes
+      src, dst: end nodes of each edge, a pair may be listed many times
+      weight: edge weights, summed over the listings of a pair
+    '''
+    src = np.asarray(src, dtype=np.int64)
+    dst = np.asarray(dst, dtype=np.int64)
+    weight = np.asarray(weight, dtype=np.float64)
+    # follow every edge both ways, then merge the listings of each pair
+    keys, inverse = np.unique(np.concatenate((src * num_nodes + dst,
+                                              dst * num_nodes + src)),
+                              return_inverse=True)
+    weights = np.bincount(inverse, weights=np.concatenate((weight, weight)),
+                          minlength=len(keys))
+    heads = keys // max(num_nodes, 1)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(np.bincount(heads, minlength=num_nodes))
+    return CSRGraph(indptr, (keys % max(num_nodes, 1)).astype(np.int32),
+                    weights.astype(np.float32))
+
+def alias_tables(graph):
+    '''
+    Return the flat first-order alias tables of "graph", see the module
+    docstring.
+
+    Returns:
+      alias: int32 (2E,) alias positions within each node
+      prob: float64 (2E,) alias probabilities
+    '''
+    alias = np.zeros(len(graph.indices), dtype=np.int32)
+    prob = np.zeros(len(graph.indices))
+    for node in np.flatnonzero(graph.degree() > 0).tolist():
+        start, end = graph.indptr[node], graph.indptr[node + 1]
+        weights = graph.weights[start:end].astype(np.float64)
+        alias[start:end], prob[start:end] = alias_setup(weights /
+                                                        weights.sum())
+    return alias, prob
+
+def draw_neighbors(graph, tables, nodes, rng):
+    '''Draw one neighbor of each of "nodes" by edge weight'''
+    alias, prob = tables
+    start = graph.indptr[nodes]
+    degree = graph.indptr[nodes + 1] - start
+    pick = (rng.random(len(nodes)) * degree).astype(np.int64)
+    pos = start + pick
+    pick = np.where(rng.random(len(nodes)) < prob[pos], pick, alias[pos])
+    return graph.indices[start + pick]
+
+def batch_walks(graph, tables, starts, walk_len, p=1, q=1, rng=None):
+    '''
+    Second-order (p, q) random walks from all of "starts" at once.
+
+    Every walker takes its next step in the same round. After the first
+    step, a neighbor drawn by edge weight is accepted with its factor,
+    1/p back to the previous node, 1 next to it and 1/q away from it, over
+    the largest factor, and the rejected walkers draw again. A neighbor is
+    thus taken with probability proportional to weight * factor.
+
+    Args:
+      graph: CSRGraph
+      tables: (alias, prob) from alias_tables
+      starts: start node of each walk
+      walk_len: number of nodes per walk
+      p, q(default=1): return and in-out parameters
+      rng(default=None): numpy Generator, a fresh one if None
+    Returns:
+      walks: int32 (len(starts), walk_len) node IDs, a walk from a node
+        without neighbors is padded with -1 after the start
+    '''
+    rng = np.random.default_rng() if rng is None else rng
+    starts = np.asarray(starts, dtype=np.int64)
+    walks = np.full((len(starts), walk_len), -1, dtype=np.int32)
+    if walk_len == 0:
+        return walks
+    walks[:, 0] = starts
+    # every later node has a neighbor, the one it was reached from
+    active = np.flatnonzero(graph.degree()[starts] > 0)
+    if walk_len > 1:
+        walks[active, 1] = draw_neighbors(graph, tables, starts[active], rng)
+    max_factor = max(1.0 / p, 1.0, 1.0 / q)
+    for step in range(2, walk_len):
+        prev = walks[active, step - 2].astype(np.int64)
+        cur = walks[active, step - 1].astype(np.int64)
+        todo = np.arange(len(active))
+        while len(todo):
+            nbrs = draw_neighbors(graph, tables, cur[todo], rng)
+            bar = rng.random(len(todo)) * max_factor
+            back = nbrs == prev[todo]
+            # A neighbor other than "prev" has factor 1 or 1/q, and only a
+            # bar between the two needs the edge lookup to decide.
+            accept = np.where(back, bar < 1.0 / p, bar < min(1.0, 1.0 / q))
+            check = np.flatnonzero(~back & ~accept &
+                                   (bar < max(1.0, 1.0 / q)))
+            accept[check] = bar[check] < np.where(graph.has_edge_pairs(
+                prev[todo[check]], nbrs[check]), 1.0, 1.0 / q)
+            walks[active[todo[accept]], step] = nbrs[accept]
+            todo = todo[~accept]
+    return walks
@@ -0,0 +1,249 @@
+# File name: doc_store.py
+# python version: 3.5+
+# Description:
+#   Compact document store that keeps every document as an array of word
+#   IDs and reads it on demand.
+'''Document store
+
+A document store is one array bundle (see util.create_arrays) with the
+attributes {"format": "iir-docs", "version": 3} and these arrays:
+
+  word_bytes uint8   (B,)    UTF-8 bytes of the sorted word vocabulary
+  word_offsets int64 (W+1,)  word ID w is
+                             word_bytes[word_offsets[w]:word_offsets[w+1]]
+  doc_names  <U*     (D,)    sorted document file names
+  offsets    int64   (D+1,)  words of document d are [offsets[d], offsets[d+1])
+  tokens     int32   (N,)    word IDs of all documents, in reading order
+  vocab_offsets int64 (D+1,) vocabulary of document d is
+                             [vocab_offsets[d], vocab_offsets[d+1])
+  vocab_ids  int32   (V,)    sorted distinct word IDs of each document
+
+Opening a store only maps the file, and a document is turned back into
+strings only when it is asked for. The per-document vocabularies are
+precomputed, so document frequencies over a set of documents are one
+concatenation and one np.unique. The words are packed as util.StringArray,
+so one very long token does not widen the whole vocabulary.
+'''
+import numpy as np
+from bisect import bisect_left
+from itertools import chain
+from collections import Counter
+from itertools import compress
+from util import load_arrays
+from util import save_arrays
+from util import string_arrays
+from util import StringArray
+from util import walk_all_files
+
+DOCS_FORMAT = 'iir-docs'
+DOCS_VERSION = 3
+# longest word that unique_words sorts in the fixed-width array
+SHORT_WORD = 16
+
+class DocStore:
+    '''Word-ID arrays of every document with an offsets table'''
+    def __init__(self, arrays):
+        self.arrays = arrays
+        self.words = StringArray(arrays['word_bytes'],
+                                 arrays['word_offsets'])
+        self.doc_names = arrays['doc_names']
+        self.offsets = arrays['offsets']
+        self.tokens = arrays['tokens']
+        self.vocab_offsets = arrays['vocab_offsets']
+        self.vocab_ids = arrays['vocab_ids']
+
+    @classmethod
+    def load(cls, filename):
+        '''Memory-map a document store file'''
+        arrays, attrs = load_arrays(filename)
+        if attrs.get('format') != DOCS_FORMAT or \
+                attrs.get('version') != DOCS_VERSION:
+            raise ValueError('{0} is not a version {1} document store'.format(
+                             filename, DOCS_VERSION))
+        return cls(arrays)
+
+    @classmethod
+    def from_dir(cls, doc_dir):
+        '''Build the same compact arrays in memory from "doc_dir"'''
+        return cls(doc_store_arrays(doc_dir))
+
+    def __len__(self):
+        return len(self.doc_names)
+
+    def __contains__(self, doc):
+        return self.doc_id(doc) >= 0
+
+    def doc_id(self, doc):
+        '''Return the position of file name "doc", or -1 if it is absent'''
+        pos = int(np.searchsorted(self.doc_names, doc))
+        if pos < len(self.doc_names) and self.doc_names[pos] == doc:
+            return pos
+        return -1
+
+    def word_ids(self, doc):
+        '''Return the word IDs of "doc" in reading order'''
+        pos = self.doc_id(doc)
+        if pos < 0:
+            raise KeyError(doc)
+        return self.tokens[self.offsets[pos]:self.offsets[pos + 1]]
+
+    def doc_words(self, doc):
+        '''Return the words of "doc" in reading order'''
+        return self.words.take(self.word_ids(doc))
+
+    def text(self, doc):
+        '''Return the whole text of "doc" without spaces'''
+        return ''.join(self.doc_words(doc))
+
+    def vocabulary_ids(self, doc):
+        '''Return the sorted distinct word IDs of "doc"'''
+        pos = self.doc_id(doc)
+        if pos < 0:
+            raise KeyError(doc)
+        return self.vocab_ids[self.vocab_offsets[pos]:
+                              self.vocab_offsets[pos + 1]]
+
+    def vocabulary(self, doc):
+        '''Return the set of words in "doc"'''
+        return set(self.words.take(self.vocabulary_ids(doc)))
+
+    def word_id(self, words):
+        '''Return the word IDs of a list of words, -1 for unknown ones'''
+        return self.words.search(words)
+
+    def doc_frequencies(self, docs, words):
+        '''Return how many of "docs" contain each of "words"'''
+        vocabs = [self.vocabulary_ids(doc) for doc in docs]
+        word_ids = self.word_id(words)
+        if not vocabs or len(word_ids) == 0:
+            return np.zeros(len(word_ids), dtype=np.int64)
+        doc_word_ids, counts = np.unique(np.concatenate(vocabs),
+                                         return_counts=True)
+        pos = np.searchsorted(doc_word_ids, word_ids)
+        pos[pos == len(doc_word_ids)] = 0
+        return np.where(doc_word_ids[pos] == word_ids, counts[pos], 0)
+
+class DictDocStore:
+    '''
+    Word lists of the documents of a directory, with the methods of
+    DocStore. It only reads the files, so it loads much faster than
+    DocStore.from_dir, which also numbers the words.
+    '''
+    def __init__(self, words_dict):
+        self.words_dict = words_dict
+
+    @classmethod
+    def from_dir(cls, doc_dir):
+        '''Read every document in "doc_dir"'''
+        return cls(read_doc_dir(doc_dir))
+
+    def __len__(self):
+        return len(self.words_dict)
+
+    def __contains__(self, doc):
+        return doc in self.words_dict
+
+    def doc_words(self, doc):
+        '''Return the words of "doc" in reading order'''
+        return self.words_dict[doc]
+
+    def text(self, doc):
+        '''Return the whole text of "doc" without spaces'''
+        return ''.join(self.words_dict[doc])
+
+    def vocabulary(self, doc):
+        '''Return the set of words in "doc"'''
+        return set(self.words_dict[doc])
+
+    def doc_frequencies(self, docs, words):
+        '''Return how many of "docs" contain each of "words"'''
+        counts = Counter()
+        for doc in docs:
+            counts.update(self.vocabulary(doc))
+        return np.array([counts[word] for word in words], dtype=np.int64)
+
+def read_doc_dir(doc_dir):
+    '''Return the file name to words dict of the documents in "doc_dir"'''
+    return read_doc_files(walk_all_files(doc_dir))
+
+def read_doc_files(files):
+    '''Return the file name to words dict of a list of (filename, filepath)'''
+    words_dict = {}
+    for filename, filepath in files:
+        with open(filepath) as docfile:
+            words_dict[filename] = docfile.read().split()
+    return words_dict
+
+def doc_store_arrays(doc_dir):
+    '''Read every document in "doc_dir" into document store arrays'''
+    return pack_doc_store(read_doc_dir(doc_dir))
+
+def unique_words(words):
+    '''
+    Number a list of words by their sorted vocabulary.
+
+    Words of up to SHORT_WORD chars are sorted together in one fixed-width
+    array, and the few longer ones apart, so a long token does not widen
+    the array of all the words.
+
+    Returns:
+      vocab: sorted list of the distinct words
+      ids: int32 array, words[i] is vocab[ids[i]]
+    '''
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    short = lengths <= SHORT_WORD
+    short_vocab, short_ids = np.unique(np.array(list(compress(words, short)),
+                                                dtype=np.str_),
+                                       return_inverse=True)
+    long_words = list(compress(words, ~short))
+    long_vocab = sorted(set(long_words))
+    # a long word goes before the short words it sorts before
+    pos = np.array([bisect_left(short_vocab, word) for word in long_vocab],
+                   dtype=np.int64)
+    short_new = np.arange(len(short_vocab)) + \
+        np.searchsorted(pos, np.arange(len(short_vocab)), side='right')
+    long_new = pos + np.arange(len(long_vocab))
+    vocab = np.empty(len(short_vocab) + len(long_vocab), dtype=object)
+    vocab[short_new] = short_vocab.tolist()
+    vocab[long_new] = long_vocab
+    ids = np.zeros(len(words), dtype=np.int32)
+    ids[short] = short_new[short_ids.reshape(-1)]
+    if long_words:
+        long_pos = {word: ind for ind, word in enumerate(long_vocab)}
+        ids[~short] = long_new[[long_pos[word] for word in long_words]]
+    return vocab.tolist(), ids
+
+def pack_doc_store(words_dict):
+    '''Return the document store arrays of a file name to words dict'''
+    doc_names = sorted(words_dict)
+    counts = np.array([len(words_dict[doc]) for doc in doc_names],
+                      dtype=np.int64)
+    words, tokens = unique_words(list(chain.from_iterable(
+        words_dict[doc] for doc in doc_names)))
+    offsets = np.zeros(len(doc_names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    # the vocabulary of each document, as sorted distinct (doc, word) pairs
+    num_words = max(len(words), 1)
+    pairs = np.sort(np.repeat(np.arange(len(doc_names), dtype=np.int64),
+                              counts) * num_words + tokens)
+    pairs = pairs[np.diff(pairs, prepend=-1) != 0]
+    vocab_offsets = np.zeros(len(doc_names) + 1, dtype=np.int64)
+    vocab_offsets[1:] = np.cumsum(np.bincount(pairs // num_words,
+                                              minlength=len(doc_names)))
+    word_bytes, word_offsets = string_arrays(words)
+    return {'word_bytes': word_bytes,
+            'word_offsets': word_offsets,
+            'doc_names': np.array(doc_names, dtype=np.str_),
+            'offsets': offsets,
+            'tokens': tokens,
+            'vocab_offsets': vocab_offsets,
+            'vocab_ids': (pairs % num_words).astype(np.int32)}
+
+def write_doc_store(filename, doc_dir):
+    '''Write the documents of "doc_dir" as a document store file'''
+    save_doc_store(filename, doc_store_arrays(doc_dir))
+
+def save_doc_store(filename, arrays):
+    '''Write document store arrays as a document store file'''
+    save_arrays(filename, arrays,
+                {'format': DOCS_FORMAT, 'version': DOCS_VERSION})
@@ -23,11 +23,16 @@ class IIREnvironment:
                  bglm_file, keyword_dirname, doc_dir, sim_keyword_file,
                  max_queries=5, patience_mean=5, patience_std=2,
                  patience_min=1, ap_thres_mean=0.5, ap_thres_std=0.1,
-                 ap_thres_min=0.1):
+                 ap_thres_min=0.1, retrieval_system=None):
         self.query_list = read_queries(query_file)
         self.ans_dict = read_answers(ans_file)
-        self.retrieval_system = RetrievalSystem(
-                index_file, doclen_file, bglm_file, keyword_dirname, doc_dir)
+        # Several environments can share one loaded retrieval system, each
+        # one keeps its own session.
+        if retrieval_system is None:
+            retrieval_system = RetrievalSystem(index_file, doclen_file,
+                    bglm_file, keyword_dirname, doc_dir)
+        self.retrieval_system = retrieval_system
+        self.session = retrieval_system.new_session()
         self.sim_keyword_file = sim_keyword_file
         self.max_queries = max_queries
         self.patience_mean = patience_mean
@@ -43,13 +48,13 @@ class IIREnvironment:
     def act(self, action):
         '''Agent take actions through this method
         '''
-        feedback_input_to_user = self.retrieval_system.request_feedback(action)
+        feedback_input_to_user = self.session.request_feedback(action)
         user_feedback, like, is_terminal = self.curr_user.react(
-                                            self.retrieval_system.ranking_list,
+                                            self.session.ranking_list,
                                             action, feedback_input_to_user)
         self.observation = None
         if user_feedback is not None:
-            self.observation = self.retrieval_system.feedback(action,
+            self.observation = self.session.feedback(action,
                                         feedback_input_to_user[user_feedback])
         return (self.observation, like, is_terminal, user_feedback)
 
@@ -90,7 +95,7 @@ class IIREnvironment:
         # TODO: Maybe we can specify user type.
         self.curr_user = self.__rand_user()
         self.observation = \
-            self.retrieval_system.query(self.curr_user.curr_query)
+            self.session.query(self.curr_user.curr_query)
         return (self.observation, self.curr_user)
 
     def next_query(self):
@@ -103,7 +108,7 @@ class IIREnvironment:
         '''
         self.curr_user.next_query()
         self.observation = \
-            self.retrieval_system.query(self.curr_user.curr_query)
+            self.session.query(self.curr_user.curr_query)
         return self.observation
 
     def get_actions(self):
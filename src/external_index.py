@@ -0,0 +1,284 @@
+# File name: external_index.py
+# python version: 3.5+
+# Description:
+#   Build the binary index of a corpus larger than memory, by spilling
+#   sorted runs of postings to disk and merging them.
+"""external_index.py
+
+Usage:
+    external_index.py [options] <corpus_dir> <binary_index_output>
+    external_index.py -h
+
+Options:
+    -h --help           : show help message
+    --memory=<mb>       : memory budget in megabytes [default: 1024]
+    --tmp-dir=<dir>     : directory for the sorted runs [default: .]
+    --quiet             : do not report progress
+
+The output equals the binary index that convert_index.py writes from the
+pickled index, doclen and bglm, but no count is ever held for the whole
+corpus at once. Documents are read in doc ID order, and their (term, doc,
+tf) postings are buffered until the budget is used up. The buffer is then
+sorted by term and spilled as a run, so every run covers a contiguous range
+of doc IDs. The merge walks the terms in chunks that fit the budget, takes
+the slice of each chunk from every run and writes it at its final place,
+together with the per-term statistics and background counts.
+"""
+import os
+import sys
+import resource
+import tempfile
+import numpy as np
+from array import array
+from docopt import docopt
+from tqdm import tqdm
+from util import create_arrays
+from util import load_arrays
+from util import save_arrays
+from util import walk_all_files
+from binary_index import INDEX_FORMAT
+from binary_index import INDEX_VERSION
+from create_inverted_index import count_doc_tokens
+
+# rough memory cost of a buffered posting, including the spill sort
+POSTING_BYTES = 40
+# rough memory cost of a distinct token in the buffer
+TERM_BYTES = 160
+
+class RunWriter:
+    '''Buffer the postings of consecutive documents and spill sorted runs'''
+    def __init__(self, run_dir, memory_bytes):
+        self.run_dir = run_dir
+        self.memory_bytes = memory_bytes
+        self.runs = []
+        self.reset()
+
+    def reset(self):
+        self.term_ids = {}
+        self.terms = array('i')
+        self.doc_ids = array('i')
+        self.tfs = array('i')
+
+    def nbytes(self):
+        '''Estimated memory held by the buffer'''
+        return POSTING_BYTES * len(self.tfs) + TERM_BYTES * len(self.term_ids)
+
+    def add(self, doc_id, counts):
+        '''Add the token counts of document "doc_id"'''
+        term_ids = self.term_ids
+        for token, tf in counts.items():
+            self.terms.append(term_ids.setdefault(token, len(term_ids)))
+            self.doc_ids.append(doc_id)
+            self.tfs.append(tf)
+        if self.nbytes() >= self.memory_bytes:
+            self.spill()
+
+    def spill(self):
+        '''Write the buffer as a run sorted by term, then by doc ID'''
+        if not len(self.tfs):
+            return
+        vocab = np.array(list(self.term_ids), dtype=np.str_)
+        vocab_order = np.argsort(vocab)
+        rank = np.zeros(len(vocab), dtype=np.int64)
+        rank[vocab_order] = np.arange(len(vocab))
+        terms = rank[np.frombuffer(self.terms, dtype=np.int32)]
+        # documents were added in doc ID order, which a stable sort keeps
+        order = np.argsort(terms, kind='stable')
+        offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum(np.bincount(terms, minlength=len(vocab)))
+        filename = os.path.join(self.run_dir,
+                                'run-{0:06d}'.format(len(self.runs)))
+        save_arrays(filename, {
+            'vocab': vocab[vocab_order],
+            'offsets': offsets,
+            'doc_ids': np.frombuffer(self.doc_ids, dtype=np.int32)[order],
+            'tfs': np.frombuffer(self.tfs, dtype=np.int32)[order]})
+        self.runs.append(filename)
+        self.reset()
+
+def write_slice(out, start, values):
+    '''
+    Write "values" to the array "out" from create_arrays at "start",
+    through a map that is dropped at once, so that written pages do not
+    pile up in the resident set.
+    '''
+    if len(values) == 0:
+        return
+    window = np.memmap(out.filename, dtype=out.dtype, mode='r+',
+                       offset=out.offset + start * out.itemsize,
+                       shape=len(values))
+    window[:] = values
+    window.flush()
+    del window
+
+def read_run_chunk(filename, lo, bound):
+    '''
+    Copy the terms of a run from term "lo" up to, but not including, the
+    term "bound" (to the end if None), with their postings, without keeping
+    the run mapped.
+
+    Returns:
+      vocab: terms of the chunk
+      offsets: posting offsets of the chunk terms, relative to its start
+      doc_ids, tfs: postings of the chunk
+    '''
+    arrays, _ = load_arrays(filename)
+    run_vocab = arrays['vocab']
+    hi = len(run_vocab) if bound is None else \
+        lo + int(np.searchsorted(run_vocab[lo:], bound))
+    offsets = np.array(arrays['offsets'][lo:hi + 1])
+    start, end = offsets[0], offsets[-1]
+    return (np.array(run_vocab[lo:hi]), offsets - start,
+            np.array(arrays['doc_ids'][start:end]),
+            np.array(arrays['tfs'][start:end]))
+
+def merge_vocab(runs, chunk_size):
+    '''
+    Return the sorted union of the run vocabularies and the postings count
+    of each term, reading "chunk_size" terms of a run at a time.
+    '''
+    vocab = np.zeros(0, dtype=np.str_)
+    for run in runs:
+        arrays, _ = load_arrays(run)
+        # both are sorted, which a stable sort merges in one pass
+        vocab = np.sort(np.concatenate((vocab, arrays['vocab'])),
+                        kind='stable')
+        vocab = vocab[np.concatenate(([True], vocab[1:] != vocab[:-1]))]
+        del arrays
+    counts = np.zeros(len(vocab), dtype=np.int64)
+    for run in runs:
+        arrays, _ = load_arrays(run)
+        run_vocab, run_offsets = arrays['vocab'], arrays['offsets']
+        for lo in range(0, len(run_vocab), chunk_size):
+            hi = min(lo + chunk_size, len(run_vocab))
+            counts[np.searchsorted(vocab, run_vocab[lo:hi])] += \
+                np.diff(run_offsets[lo:hi + 1])
+        del arrays, run_vocab, run_offsets
+    return vocab, counts
+
+def merge_runs(filename, runs, doc_names, doclen, memory_bytes,
+               progress=True):
+    '''
+    Merge sorted runs of consecutive doc ID ranges into a binary index.
+
+    Only the merged vocabulary and offsets are held whole; the terms and
+    postings of each run are read one chunk at a time.
+
+    Args:
+      filename: binary index output
+      runs: run file names, in doc ID order
+      doc_names: sorted document file names
+      doclen: document lengths, indexed by doc ID
+      memory_bytes: memory budget of one merge chunk
+      progress(default=True): show a progress bar
+    '''
+    chunk_size = max(memory_bytes // POSTING_BYTES, 1)
+    vocab, counts = merge_vocab(runs, chunk_size)
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    num_postings = int(offsets[-1])
+    doc_names = np.array(doc_names, dtype=np.str_)
+    out = create_arrays(filename, [
+        ('vocab', vocab.dtype, len(vocab)),
+        ('offsets', np.int64, len(offsets)),
+        ('doc_ids', np.int32, num_postings),
+        ('tfs', np.int32, num_postings),
+        ('bglm', np.float64, len(vocab)),
+        ('max_tf', np.int32, len(vocab)),
+        ('min_tf', np.int32, len(vocab)),
+        ('min_len', np.float64, len(vocab)),
+        ('max_len', np.float64, len(vocab)),
+        ('doc_names', doc_names.dtype, len(doc_names)),
+        ('doclen', np.float64, len(doclen))],
+        {'format': INDEX_FORMAT, 'version': INDEX_VERSION})
+    totals = np.zeros(len(vocab))
+    # cut the terms into chunks of about "chunk_size" postings
+    bounds = np.unique(np.concatenate((
+        np.searchsorted(offsets, np.arange(0, num_postings, chunk_size),
+                        side='right') - 1, [len(vocab)])))
+    # next unread term of each run
+    cursors = [0] * len(runs)
+    for first, last in tqdm(list(zip(bounds[:-1], bounds[1:])),
+                            desc='merging', disable=not progress):
+        terms = []
+        doc_ids = []
+        tfs = []
+        bound = vocab[last] if last < len(vocab) else None
+        for ind, run in enumerate(runs):
+            run_vocab, run_offsets, run_ids, run_tfs = read_run_chunk(
+                run, cursors[ind], bound)
+            cursors[ind] += len(run_vocab)
+            run_terms = first + np.searchsorted(vocab[first:last], run_vocab)
+            terms.append(np.repeat(run_terms, np.diff(run_offsets)))
+            doc_ids.append(run_ids)
+            tfs.append(run_tfs)
+            del run_vocab, run_offsets, run_terms
+        # runs are in doc ID order, so a stable sort by term is the merge
+        order = np.argsort(np.concatenate(terms), kind='stable')
+        doc_ids = np.concatenate(doc_ids)[order]
+        tfs = np.concatenate(tfs)[order]
+        del terms, order
+        write_slice(out['doc_ids'], offsets[first], doc_ids)
+        write_slice(out['tfs'], offsets[first], tfs)
+        # every merged term has postings, so no reduceat range is empty
+        starts = offsets[first:last] - offsets[first]
+        posting_len = doclen[doc_ids]
+        out['max_tf'][first:last] = np.maximum.reduceat(tfs, starts)
+        out['min_tf'][first:last] = np.minimum.reduceat(tfs, starts)
+        out['min_len'][first:last] = np.minimum.reduceat(posting_len, starts)
+        out['max_len'][first:last] = np.maximum.reduceat(posting_len, starts)
+        totals[first:last] = np.add.reduceat(tfs.astype(np.int64), starts)
+    # doclen counts the chars of a document
+    is_char = np.char.str_len(vocab) == 1
+    bichar_total = totals[~is_char].sum()
+    out['bglm'][...] = totals / np.where(is_char, doclen.sum(),
+                                         max(bichar_total, 1))
+    out['vocab'][...] = vocab
+    out['offsets'][...] = offsets
+    out['doc_names'][...] = doc_names
+    out['doclen'][...] = doclen
+    for name in out:
+        if isinstance(out[name], np.memmap):
+            out[name].flush()
+
+def build_external_index(corpus_dir, filename, memory_bytes, tmp_dir=None,
+                         progress=True):
+    '''
+    Build the binary index of "corpus_dir" within about "memory_bytes".
+
+    Args:
+      corpus_dir: corpus directory
+      filename: binary index output
+      memory_bytes: memory budget for buffered postings and merge chunks
+      tmp_dir(default=None): where the runs are spilled, removed afterwards
+      progress(default=True): show progress bars
+    '''
+    files = sorted(walk_all_files(corpus_dir))
+    doclen = np.zeros(len(files))
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as run_dir:
+        writer = RunWriter(run_dir, memory_bytes)
+        for doc_id, (_, filepath) in enumerate(tqdm(
+                files, desc='indexing', disable=not progress)):
+            counts = count_doc_tokens(filepath)
+            doclen[doc_id] = sum(tf for token, tf in counts.items()
+                                 if len(token) == 1)
+            writer.add(doc_id, counts)
+        writer.spill()
+        merge_runs(filename, writer.runs, [name for name, _ in files],
+                   doclen, memory_bytes, progress)
+        return len(writer.runs)
+
+def main(docopt_args):
+    progress = not docopt_args['--quiet']
+    num_runs = build_external_index(
+        docopt_args['<corpus_dir>'], docopt_args['<binary_index_output>'],
+        int(float(docopt_args['--memory']) * 2**20),
+        docopt_args['--tmp-dir'], progress)
+    if progress:
+        # ru_maxrss is in kilobytes on Linux
+        print('{0} runs merged, peak RSS {1:.1f} MB'.format(num_runs,
+              resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10),
+              file=sys.stderr)
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -16,7 +16,7 @@ Options:
 import networkx as nx
 from docopt import docopt
 from collections import defaultdict
-from util import read_keyword_dir
+from keyword_store import load_keywords
 from util import alias_setup
 
 class FeatGraph:
@@ -74,7 +74,7 @@ def construct_doc_graph(keyword_dir):
       doc_graph: doc-doc graph
     '''
     # This construction uses less memory
-    keyword_dict = read_keyword_dir(keyword_dir)
+    keyword_dict = load_keywords(keyword_dir)
     rev_keyword_dict = defaultdict(list)
     doc2id = {}
     rev_doc2id = {}
@@ -110,7 +110,7 @@ def construct_keyword_graph(keyword_dir):
       keyword_graph: keyword-keyword graph
     '''
     # TODO: use too many memory, fix this.
-    keyword_dict = read_keyword_dir(keyword_dir)
+    keyword_dict = load_keywords(keyword_dir)
     keyword2id = {}
     rev_keyword2id = {}
     keyword_graph = nx.Graph()
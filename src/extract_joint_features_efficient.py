@@ -1,33 +1,92 @@
 # File name: extract_joint_features_efficient.py
 # Author: Yang-de Chen
 # Date created: 12/22/2016
-# Date modified: 12/22/2016
+# Date modified: 10/18/2026
 # python version: 3.5+
 # Description:
 #   Extract features from the graph of docuemnts and keywords
 '''extract_joint_features_efficient.py
 
 Usage:
-    extract_joint_features_efficient.py <keyword-dir> <feat-type> <output>
+    extract_joint_features_efficient.py [options] <keyword-dir> <feat-type>
+                                        <output>
     extract_joint_features_efficient.py -h
+
 Options:
-    -h --help       : show help messages
+    -h --help           : show help messages
+    --walk-mode=<mode>  : precompute, lazy, rejection or batch
+                          [default: precompute]
+    --cache-mb=<mb>     : table cache of the lazy mode [default: 256]
+    --batch-size=<n>    : walkers moved together in the batch mode
+                          [default: 65536]
+    --workers=<n>       : worker processes of the batch mode [default: 1]
+    --seed=<s>          : random seed, for reproducible walks
+    --format=<fmt>      : output walks as text or npy [default: text]
+
+The walk modes draw the same second-order (p, q) walks. "precompute" builds
+an alias table for every directed edge, which takes O(sum of degree^2)
+memory. "lazy" builds the table of an edge when a walk first crosses it
+and keeps the recent ones in a bounded LRU cache. "rejection" keeps no
+edge table: it draws a neighbor by edge weight and accepts it with its
+p, q factor over the largest factor. "batch" does the same rejection for
+a whole batch of walkers at once with array-wide draws over the CSR
+arrays (see csr_graph.batch_walks).
+
+In the batch mode, each round of walks is cut into chunks of batch size
+start nodes, and every chunk draws from its own child of one
+numpy SeedSequence. Given a seed, the walks are thus the same for any
+number of workers. Chunks are written in order as they come back.
+
+"text" writes one walk of node names per line. "npy" writes an int32
+(walks, walk length) array of node IDs as a .npy file, which np.load can
+map, and the node names by ID to <output>.nodes, one per line. Every
+walk mode can write either; the other modes append their walks to the .npy
+file a batch size at a time.
 '''
+import numpy as np
 from docopt import docopt
 from collections import defaultdict
-from util import read_keyword_dir
+from multiprocessing import Pool
+from keyword_store import load_keywords
+from csr_graph import alias_tables
+from csr_graph import batch_walks
+from csr_graph import csr_graph
+from csr_graph import CSRGraph
+from util import ByteLRUCache
 from util import alias_setup
 from util import alias_draw
-from util import normalize_to_prob
 from tqdm import tqdm
 import random
 
+WALK_MODES = ('precompute', 'lazy', 'rejection', 'batch')
+OUTPUT_FORMATS = ('text', 'npy')
+
+# graph, tables and walk settings of the worker processes, set by init_walker
+worker_walker = None
+
+def init_walker(graph_arrays, tables, walk_len, p, q):
+    '''Rebuild the CSRGraph from its arrays and keep the walk settings'''
+    global worker_walker
+    worker_walker = (CSRGraph(*graph_arrays), tables, walk_len, p, q)
+
+def walk_chunk(task):
+    '''Return the batch walks from (start nodes, SeedSequence)'''
+    starts, seed_seq = task
+    graph, tables, walk_len, p, q = worker_walker
+    return batch_walks(graph, tables, starts, walk_len, p, q,
+                       np.random.default_rng(seed_seq))
+
 class FeatGraph:
     '''Perform node2vec with random walk + skip-gram'''
 
     def __init__(self, graph, node2id, rev_node2id, dim=64, p=1, q=1,
-                 num_walks=5, walk_len=20):
+                 num_walks=5, walk_len=20, walk_mode='precompute',
+                 cache_bytes=256 * 2**20, batch_size=65536, workers=1,
+                 seed=None):
+        # CSRGraph from build_graph
         self.graph = graph
+        # walks start from every node that has an edge
+        self.nodes = np.flatnonzero(graph.degree() > 0).tolist()
         self.node2id = node2id
         self.rev_node2id = rev_node2id
         self.dim = dim
@@ -35,8 +94,25 @@ class FeatGraph:
         self.q = q
         self.num_walks = num_walks
         self.walk_len = walk_len
+        if walk_mode not in WALK_MODES:
+            raise ValueError('unknown walk mode {0}'.format(walk_mode))
+        if workers > 1 and walk_mode != 'batch':
+            raise ValueError('only the batch mode runs in worker processes')
+        self.walk_mode = walk_mode
         self.sample_node_graph = {}
+        # alias tables of directed edges, all of them in the precompute
+        # mode, or the recently used ones in the lazy mode
         self.sample_edge_graph = {}
+        self.edge_cache = ByteLRUCache(cache_bytes) if walk_mode == 'lazy' \
+            else None
+        # largest p, q factor, the acceptance bound of the rejection mode
+        self.max_factor = max(1.0 / p, 1.0, 1.0 / q)
+        # flat first-order tables, worker processes and seed of the batch
+        # mode, a seed of None draws fresh entropy
+        self.batch_size = batch_size
+        self.tables = None
+        self.workers = workers
+        self.seed = seed
         self.__preprocess_transition_probs()
 
     def __preprocess_transition_probs(self):
@@ -44,17 +120,23 @@ class FeatGraph:
         Preprocessing of transition probabilities for guilding the random walks
         '''
         print('=== preprocessing node start ===')
-        for node in self.graph:
-            edge_prob = normalize_to_prob(self.graph[node]['weight'])
-            J, q = alias_setup(edge_prob)
+        if self.walk_mode == 'batch':
+            self.tables = alias_tables(self.graph)
+            print('=== preprocessing node end ===')
+            return
+        for node in self.nodes:
+            weights = self.graph.edge_weights(node).astype(np.float64)
+            J, q = alias_setup(weights / weights.sum())
             if node not in self.sample_node_graph:
                 self.sample_node_graph[node] = {}
             self.sample_node_graph[node]['alias_table'] = J
             self.sample_node_graph[node]['alias_prob'] = q
         print('=== preprocessing node end ===')
+        if self.walk_mode != 'precompute':
+            return
         print('=== preprocessing edge start ===')
-        for node in tqdm(self.graph):
-            for nbr in self.graph[node]['adjacent']:
+        for node in tqdm(self.nodes):
+            for nbr in self.graph.neighbors(node).tolist():
                 J, q = self.__get_alias_edge(node, nbr)
                 if (node, nbr) not in self.sample_edge_graph:
                     self.sample_edge_graph[(node, nbr)] = {}
@@ -63,16 +145,42 @@ class FeatGraph:
         print('=== preprocessing edge end ===')
 
     def __get_alias_edge(self, src, dst):
-        weights = []
-        for dst_nbr, dst_nbr_weight in zip(self.graph[dst]['adjacent'],
-                                           self.graph[dst]['weight']):
-            if dst_nbr == src:
-                weights.append(dst_nbr_weight / self.p)
-            elif src in self.graph[dst_nbr]['adj_dict']:
-                weights.append(dst_nbr_weight)
+        dst_nbrs = self.graph.neighbors(dst)
+        weights = self.graph.edge_weights(dst).astype(np.float64)
+        # return to "src" with 1/p, stay next to it with 1, move away with 1/q
+        weights = np.where(dst_nbrs == src, weights / self.p,
+                           np.where(self.graph.has_edges(src, dst_nbrs),
+                                    weights, weights / self.q))
+        return alias_setup(weights / weights.sum())
+
+    def __next_node(self, prev_node, cur):
+        '''Draw the step after moving from "prev_node" to "cur"'''
+        cur_nbrs = self.graph.neighbors(cur)
+        if self.walk_mode == 'precompute':
+            edge = self.sample_edge_graph[(prev_node, cur)]
+            return int(cur_nbrs[alias_draw(edge['alias_table'],
+                                           edge['alias_prob'])])
+        if self.walk_mode == 'lazy':
+            tables = self.edge_cache.get((prev_node, cur))
+            if tables is None:
+                tables = self.__get_alias_edge(prev_node, cur)
+                self.edge_cache.put((prev_node, cur), tables)
+            return int(cur_nbrs[alias_draw(*tables)])
+        # Draw by edge weight from the first-order table and accept with
+        # factor / max_factor, so a neighbor is taken with probability
+        # proportional to weight * factor, as in the edge tables.
+        node = self.sample_node_graph[cur]
+        while True:
+            nbr = int(cur_nbrs[alias_draw(node['alias_table'],
+                                          node['alias_prob'])])
+            if nbr == prev_node:
+                factor = 1.0 / self.p
+            elif self.graph.has_edge(prev_node, nbr):
+                factor = 1.0
             else:
-                weights.append(dst_nbr_weight / self.q)
-        return alias_setup(normalize_to_prob(weights))
+                factor = 1.0 / self.q
+            if random.random() * self.max_factor < factor:
+                return nbr
 
     def run(self, n_iter=10):
         for _ in range(n_iter):
@@ -80,92 +188,156 @@ class FeatGraph:
         walks = self.__random_walks()
         return walks
 
-    def run_and_write(self, output_file, n_iter=10):
+    def run_and_write(self, output_file, n_iter=10, output_format='text'):
         for _ in range(n_iter):
             pass
 
-        with open(output_file, 'w') as outfile:
-            nodes = list(self.graph.keys())
-            for walk_iter in range(self.num_walks):
-                random.shuffle(nodes)
-                for node in nodes:
-                    walk = [self.rev_node2id[x] for x in \
-                            self.__random_walk_from_node(node)]
-                    outfile.write(' '.join(walk))
+        if output_format not in OUTPUT_FORMATS:
+            raise ValueError('unknown output format {0}'.format(
+                             output_format))
+        if output_format == 'text':
+            with open(output_file, 'w') as outfile:
+                for walk in self.__walks():
+                    outfile.write(' '.join(self.rev_node2id[x]
+                                           for x in walk))
                     outfile.write('\n')
+            return
+        with open(output_file + '.nodes', 'w') as outfile:
+            for ind in range(self.graph.num_nodes):
+                outfile.write('{0}\n'.format(self.rev_node2id[ind]))
+        # Every walk has "walk_len" nodes, since walks start from nodes
+        # with neighbors, so the header is known before the first walk and
+        # the chunks are appended as they come.
+        with open(output_file, 'wb') as outfile:
+            np.lib.format.write_array_header_1_0(outfile, {
+                'descr': np.lib.format.dtype_to_descr(np.dtype(np.int32)),
+                'fortran_order': False,
+                'shape': (self.num_walks * len(self.nodes), self.walk_len)})
+            for walks in self.__walk_chunks():
+                outfile.write(walks.tobytes())
+
+    def __walk_chunks(self):
+        '''
+        Yield the walks as int32 arrays, one per chunk of the batch mode,
+        or per "batch_size" walks of the other modes.
+        '''
+        if self.walk_mode == 'batch':
+            yield from self.__walk_arrays()
+            return
+        chunk = []
+        for walk in self.__walks():
+            chunk.append(walk)
+            if len(chunk) == self.batch_size:
+                yield np.array(chunk, dtype=np.int32)
+                chunk = []
+        if chunk:
+            yield np.array(chunk, dtype=np.int32)
+
+    def __walks(self):
+        '''
+        Yield "num_walks" walks from every node, each round in a shuffled
+        node order.
+        '''
+        if self.walk_mode == 'batch':
+            for walks in self.__walk_arrays():
+                yield from walks.tolist()
+            return
+        nodes = list(self.nodes)
+        for walk_iter in range(self.num_walks):
+            random.shuffle(nodes)
+            for node in nodes:
+                yield self.__random_walk_from_node(node)
+
+    def __walk_arrays(self):
+        '''
+        Yield the walks of the batch mode as int32 arrays, one per chunk,
+        in order, from "workers" processes.
+        '''
+        tasks = self.__walk_tasks()
+        graph = self.graph
+        initargs = ((graph.indptr, graph.indices, graph.weights),
+                    self.tables, self.walk_len, self.p, self.q)
+        if self.workers <= 1:
+            init_walker(*initargs)
+            yield from map(walk_chunk, tasks)
+            return
+        with Pool(self.workers, init_walker, initargs) as pool:
+            yield from pool.imap(walk_chunk, tasks)
+
+    def __walk_tasks(self):
+        '''
+        Yield (start nodes, SeedSequence) of every chunk: each round
+        shuffles the nodes with its own child of the seed, and cuts them
+        into chunks of "batch_size", which draw from children of the
+        round's seed.
+        '''
+        nodes = np.array(self.nodes, dtype=np.int64)
+        chunk_starts = range(0, len(nodes), self.batch_size)
+        for round_seq in np.random.SeedSequence(self.seed).spawn(
+                self.num_walks):
+            order = nodes[np.random.default_rng(round_seq).permutation(
+                len(nodes))]
+            for start, chunk_seq in zip(chunk_starts,
+                                        round_seq.spawn(len(chunk_starts))):
+                yield order[start:start + self.batch_size], chunk_seq
 
     def __random_walk_from_node(self, start_node):
         walk = [start_node]
         while len(walk) < self.walk_len:
             cur = walk[-1]
-            cur_nbrs = self.graph[cur]['adjacent']
+            cur_nbrs = self.graph.neighbors(cur)
             cur_alias_table = self.sample_node_graph[cur]['alias_table']
             cur_alias_prob = self.sample_node_graph[cur]['alias_prob']
             if len(cur_nbrs) > 0:
                 if len(walk) == 1:
-                    walk.append(cur_nbrs[alias_draw(cur_alias_table,
-                                                    cur_alias_prob)])
+                    walk.append(int(cur_nbrs[alias_draw(cur_alias_table,
+                                                        cur_alias_prob)]))
                 else:
-                    prev_node = walk[-2]
-                    walk.append(
-                        cur_nbrs[alias_draw(
-                        self.sample_edge_graph[(prev_node,cur)]['alias_table'],
-                        self.sample_edge_graph[(prev_node,cur)]['alias_prob'])]
-                    )
+                    walk.append(self.__next_node(walk[-2], cur))
             else:
                 break
         return walk
 
     def __random_walks(self):
-        walks = []
-        nodes = list(self.graph.keys())
-        for walk_iter in range(self.num_walks):
-            random.shuffle(nodes)
-            for node in nodes:
-                walks.append(self.__random_walk_from_node(node))
-        return walks
+        return list(self.__walks())
 
 def build_graph(data_dict, thres=0.001):
     '''
     Construct a graph using data_dict, which has the following format:
     {item_i: [(item_j, score_j), (item_k, score_k)]}
+    item_j and item_k are connected with weight score_j * score_k, summed
+    over every item that lists both of them.
+
+    Returns:
+      node2id: map node name to id
+      rev_node2id: map id to node name
+      graph: CSRGraph over the node IDs
     '''
     node2id = {}
-    rev_node2id = {}
-    graph = {}
-    idx = 0
+    src = [np.zeros(0, dtype=np.int64)]
+    dst = [np.zeros(0, dtype=np.int64)]
+    weight = [np.zeros(0)]
     print('=== build_graph start ===')
     for node, node_score_list in data_dict.items():
-        for n, _ in node_score_list:
-            if n not in node2id:
-                node2id[n] = idx
-                rev_node2id[idx] = n
-                idx += 1
-        for i in range(len(node_score_list)):
-            for j in range(i+1, len(node_score_list)):
-                node_1 = node2id[node_score_list[i][0]]
-                node_2 = node2id[node_score_list[j][0]]
-                if node_1 not in graph:
-                    graph[node_1] = {'weight':[], 'adjacent': [],
-                                     'adj_dict': set()}
-                if node_2 not in graph:
-                    graph[node_2] = {'weight':[], 'adjacent': [],
-                                     'adj_dict': set()}
-                graph[node_1]['adjacent'].append(node_2)
-                graph[node_1]['weight'].append(
-                    node_score_list[i][1] * node_score_list[j][1])
-                graph[node_1]['adj_dict'].add(node_2)
-                graph[node_2]['adjacent'].append(node_1)
-                graph[node_2]['weight'].append(
-                    node_score_list[i][1] * node_score_list[j][1])
-                graph[node_2]['adj_dict'].add(node_1)
+        ids = np.array([node2id.setdefault(n, len(node2id))
+                        for n, _ in node_score_list], dtype=np.int64)
+        scores = np.array([score for _, score in node_score_list],
+                          dtype=np.float64)
+        # every pair of the list once
+        first, second = np.triu_indices(len(ids), 1)
+        src.append(ids[first])
+        dst.append(ids[second])
+        weight.append(scores[first] * scores[second])
+    rev_node2id = {ind: n for n, ind in node2id.items()}
+    graph = csr_graph(len(node2id), np.concatenate(src), np.concatenate(dst),
+                      np.concatenate(weight))
     print('=== build_graph end ===')
 
     return node2id, rev_node2id, graph
 
 def main(docopt_args):
     '''Construct the graph and run node2vec to get node features'''
-    keyword_dict = read_keyword_dir(docopt_args['<keyword-dir>'], thres=5)
+    keyword_dict = load_keywords(docopt_args['<keyword-dir>'], thres=5)
     if docopt_args['<feat-type>'] == 'doc':
         rev_keyword_dict = defaultdict(list)
         for ind, (doc, keyword_list) in enumerate(keyword_dict.items()):
@@ -175,10 +347,22 @@ def main(docopt_args):
     elif docopt_args['<feat-type>'] == 'keyword':
         node2id, rev_node2id, graph = build_graph(keyword_dict)
 
+    seed = docopt_args['--seed']
+    if seed is not None:
+        seed = int(seed)
+        # the other walk modes draw from the global generators
+        random.seed(seed)
+        np.random.seed(seed)
     print('setup up start')
-    feat_graph = FeatGraph(graph, node2id, rev_node2id)
+    feat_graph = FeatGraph(graph, node2id, rev_node2id,
+                           walk_mode=docopt_args['--walk-mode'],
+                           cache_bytes=int(float(docopt_args['--cache-mb']) *
+                                           2**20),
+                           batch_size=int(docopt_args['--batch-size']),
+                           workers=int(docopt_args['--workers']), seed=seed)
     print('setup up end')
-    feat_graph.run_and_write(docopt_args['<output>'])
+    feat_graph.run_and_write(docopt_args['<output>'],
+                             output_format=docopt_args['--format'])
 
 if __name__ == '__main__':
     main(docopt(__doc__))
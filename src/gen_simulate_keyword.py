@@ -1,22 +1,59 @@
 # File name: gen_simulate_keyword.py
 # Author: Yang-de Chen
 # Date created: 12/14/2016
-# Date modified: 12/19/2016
+# Date modified: 10/18/2026
 # python version: 3.5+
 # Description:
 #   Generate releated keyword for each keyword for simulation.
 '''Generate Keyword for simulation
 
 Usage:
-    gen_simulate_keyword.py <ptv-ans> <doc-dir> <output>
+    gen_simulate_keyword.py [options] <ptv-ans> <doc-dir> <output>
     gen_simulate_keyword.py -h
+
 Options:
     -h --help       : show help messages
+    --workers=<n>   : number of worker processes [default: 1]
+
+<doc-dir> is a document directory or a document store file (see
+doc_store.py). Either way, every document is tokenized once, and its
+precomputed vocabulary is shared by all the queries it answers. Related
+keywords are written in sorted order.
 '''
-import os
-import sys
+import numpy as np
 from docopt import docopt
-from collections import defaultdict
+from multiprocessing import Pool
+from util import is_array_bundle
+from doc_store import DocStore
+
+# document store of the worker processes, set by init_worker
+worker_store = None
+
+def related_keywords(doc_store, docs):
+    '''
+    Return the sorted words that appear in more than half of "docs".
+
+    Args:
+      doc_store: DocStore holding "docs"
+      docs: answer document names, a document listed twice counts twice
+    '''
+    if not docs:
+        return []
+    word_ids, counts = np.unique(np.concatenate(
+        [doc_store.vocabulary_ids(doc) for doc in docs]), return_counts=True)
+    return doc_store.words.take(word_ids[counts > len(docs) / 2])
+
+def init_worker(doc_path, arrays=None):
+    '''Open the document store file, or take the arrays built in memory'''
+    global worker_store
+    worker_store = DocStore(arrays) if arrays is not None else \
+        DocStore.load(doc_path)
+
+def answer_line(line):
+    '''Return the output line of one line of the answer file'''
+    query, *ans = line.strip().split()
+    return '{0} {1}\n'.format(query, ' '.join(related_keywords(worker_store,
+                                                               ans)))
 
 # TODO: Obviously, this is not very reasonable. Refine this so that it can
 # generate more sensible simulation.
@@ -25,27 +62,22 @@ def main(docopt_args):
     For each keyword, generate related keywords if it appears in more than
     half of the documents.
     '''
+    doc_path = docopt_args['<doc-dir>']
+    workers = int(docopt_args['--workers'])
+    # a store file is mapped by every worker, a directory is read once here
+    # and its arrays are handed to the workers
+    arrays = None if is_array_bundle(doc_path) else \
+        DocStore.from_dir(doc_path).arrays
     with open(docopt_args['<ptv-ans>']) as ans_file:
-        with open(docopt_args['<output>'], 'w') as out_file:
-            for line in ans_file:
-                query, *ans = line.strip().split()
-                num_ans = len(ans)
-                word_count = defaultdict(int)
-                for doc in ans:
-                    doc_set = set()
-                    with open(os.path.join(docopt_args['<doc-dir>'],
-                                           doc)) as f:
-                        for doc_line in f:
-                            for word in doc_line.strip().split():
-                                doc_set.add(word)
-                    for word in doc_set:
-                        word_count[word] += 1
-                word_list = []
-                for word, count in word_count.items():
-                    # appear in more than half of the documents
-                    if count > num_ans / 2:
-                        word_list.append(word)
-                out_file.write('{0} {1}\n'.format(query, ' '.join(word_list)))
+        lines = ans_file.readlines()
+    with open(docopt_args['<output>'], 'w') as out_file:
+        if workers <= 1:
+            init_worker(doc_path, arrays)
+            out_file.writelines(answer_line(line) for line in lines)
+        else:
+            with Pool(workers, init_worker, (doc_path, arrays)) as pool:
+                out_file.writelines(pool.imap(answer_line, lines,
+                                              chunksize=64))
 
 if __name__ == '__main__':
     main(docopt(__doc__))
@@ -0,0 +1,127 @@
+# File name: graph_rank.py
+# python version: 3.5+
+# Description:
+#   Word co-occurrence graph, PageRank and core numbers on NumPy arrays,
+#   as a faster replacement of the networkx calls in keyterm_generate.py.
+'''Array-based graph ranking
+
+A graph with N nodes is given by its undirected edges, each listed once:
+  src, dst   int64   (E,)   end nodes of each edge, src != dst
+  weight     float64 (E,)   edge weight
+Results are arrays indexed by node.
+'''
+import numpy as np
+
+def cooccurrence_graph(lines, window_size):
+    '''
+    Build the word co-occurrence graph of a document, with the same edges
+    and weights as the networkx graph of keyterm_generate.py.
+
+    Args:
+      lines: lines of the document
+      window_size: co-occurrence window size
+    Returns:
+      nodes: list of words that have an edge, node ID = position
+      src, dst, weight: undirected edges, see the module docstring
+    '''
+    word2id = {}
+    ids = []
+    line_ids = []
+    for line_id, line in enumerate(lines):
+        for word in line.strip().split():
+            ids.append(word2id.setdefault(word, len(word2id)))
+            line_ids.append(line_id)
+    ids = np.array(ids, dtype=np.int64)
+    line_ids = np.array(line_ids, dtype=np.int64)
+    keys = [np.zeros(0, dtype=np.int64)]
+    counts = [np.zeros(0)]
+    for dist in range(1, window_size + 1):
+        first, second = ids[:-dist], ids[dist:]
+        pair = (line_ids[:-dist] == line_ids[dist:]) & (first != second)
+        low = np.minimum(first[pair], second[pair])
+        high = np.maximum(first[pair], second[pair])
+        keys.append(low * len(word2id) + high)
+        # A window covers [ind - window_size, ind + window_size), so words
+        # closer than window_size see each other from both sides.
+        counts.append(np.full(len(low), 2.0 if dist < window_size else 1.0))
+    keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+    weight = np.bincount(inverse, weights=np.concatenate(counts),
+                         minlength=len(keys))
+    src, dst = keys // max(len(word2id), 1), keys % max(len(word2id), 1)
+    # only words with an edge are graph nodes
+    used, node_ids = np.unique(np.concatenate((src, dst)),
+                               return_inverse=True)
+    words = list(word2id)
+    nodes = [words[word_id] for word_id in used.tolist()]
+    return nodes, node_ids[:len(src)], node_ids[len(src):], weight
+
+def pagerank(num_nodes, src, dst, weight, alpha=0.85, max_iter=100,
+             tol=1.0e-6):
+    '''
+    PageRank by power iteration, with the defaults and stopping rule of
+    networkx.pagerank on an undirected weighted graph.
+
+    Raises:
+      RuntimeError: if it does not converge within "max_iter" iterations
+    '''
+    if num_nodes == 0:
+        return np.zeros(0)
+    # every undirected edge is followed both ways
+    heads = np.concatenate((src, dst))
+    tails = np.concatenate((dst, src))
+    weights = np.concatenate((weight, weight))
+    out_weight = np.bincount(heads, weights=weights, minlength=num_nodes)
+    dangling = out_weight == 0
+    share = weights / out_weight[heads]
+    x = np.full(num_nodes, 1.0 / num_nodes)
+    for _ in range(max_iter):
+        last = x
+        x = alpha * (np.bincount(tails, weights=last[heads] * share,
+                                 minlength=num_nodes) +
+                     last[dangling].sum() / num_nodes) + \
+            (1.0 - alpha) / num_nodes
+        if np.abs(x - last).sum() < num_nodes * tol:
+            return x
+    raise RuntimeError('pagerank did not converge in {0} iterations'.format(
+                       max_iter))
+
+def core_number(num_nodes, src, dst):
+    '''
+    Core number of every node, as networkx.core_number, by the bucket
+    algorithm of Batagelj and Zaversnik, which takes O(N + E) steps.
+    '''
+    # adjacency lists in CSR form: the neighbors of v are
+    # adj[indptr[v]:indptr[v + 1]]
+    heads = np.concatenate((src, dst))
+    adj = np.concatenate((dst, src))[np.argsort(heads, kind='stable')]
+    degree = np.bincount(heads, minlength=num_nodes)
+    indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+    indptr[1:] = np.cumsum(degree)
+    # nodes sorted by degree, the position of each node in that order,
+    # and the first position of each degree
+    vert = np.argsort(degree, kind='stable')
+    pos = np.zeros(num_nodes, dtype=np.int64)
+    pos[vert] = np.arange(num_nodes)
+    bin_start = np.zeros(degree.max() + 1 if num_nodes else 1,
+                         dtype=np.int64)
+    bin_start[1:] = np.cumsum(np.bincount(degree))[:-1]
+    adj, indptr = adj.tolist(), indptr.tolist()
+    vert, pos, bin_start = vert.tolist(), pos.tolist(), bin_start.tolist()
+    degree = degree.tolist()
+    for ind in range(num_nodes):
+        node = vert[ind]
+        node_degree = degree[node]
+        for other in adj[indptr[node]:indptr[node + 1]]:
+            other_degree = degree[other]
+            if other_degree > node_degree:
+                # move "other" to the front of its bin, then into the bin
+                # below by shrinking its bin from the front
+                front = bin_start[other_degree]
+                front_node = vert[front]
+                if front_node != other:
+                    other_pos = pos[other]
+                    vert[front], vert[other_pos] = other, front_node
+                    pos[other], pos[front_node] = front, other_pos
+                bin_start[other_degree] += 1
+                degree[other] = other_degree - 1
+    return np.array(degree, dtype=np.int64)
@@ -1,7 +1,7 @@
 # File name: keyterm_generate.py
 # Author: Yang-de Chen
 # Date created: 12/14/2016
-# Date modified: 12/19/2016
+# Date modified: 10/18/2026
 # python version: 3.5+
 # Description:
 #   Generate Keyword for each documents based on core-number and
@@ -9,65 +9,171 @@
 '''Generate keyword for each documents
 
 Usage:
-    keyterm_generate.py <doc-dir> <stopword> <window-size> <outdir>
+    keyterm_generate.py [options] <doc-dir> <stopword> <window-size> <outdir>
     keyterm_generate.py -h
+
 Options:
-    -h --help       : show help messages
+    -h --help           : show help messages
+    --workers=<n>       : number of worker processes [default: 1]
+    --cache-dir=<dir>   : reuse the keywords of unchanged documents
+    --engine=<name>     : graph engine, networkx or numpy [default: networkx]
+
+With --cache-dir, the keywords of every document are also kept under a hash
+of its text, the window size, the stopword list and the engine, so a re-run
+only processes the documents whose text or settings changed.
+
+The numpy engine builds the same graph as arrays and computes PageRank and
+core numbers without networkx (see graph_rank.py). Core numbers are equal,
+and PageRank agrees within the convergence tolerance.
 '''
 import os
 import re
 import sys
 import pickle
+import hashlib
 import networkx as nx
 from docopt import docopt
 from math import log
 from glob import glob
+from functools import partial
+from multiprocessing import Pool
 from operator import itemgetter
 from util import walk_all_files
 from util import read_stopwords
+from graph_rank import cooccurrence_graph
+from graph_rank import core_number
+from graph_rank import pagerank
 
-def main(docopt_args):
+ENGINES = ('networkx', 'numpy')
+
+def doc_keyterms(lines, stopword, window_size, engine='networkx'):
     '''
     Decide keyword via core-number * textrank, since both methods do not
     consider the highly connected phenomenon of stopwords, we should use a
     stopword list to achieve this goal.
+
+    Args:
+      lines: lines of the document
+      stopword: set of stopwords
+      window_size: co-occurrence window size
+      engine(default='networkx'): graph engine, one of ENGINES
+    Returns:
+      keywords: list of (keyword, score), sorted by descending score
+    '''
+    if engine == 'numpy':
+        text_pagerank, text_core_rank = numpy_ranks(lines, window_size)
+    else:
+        text_pagerank, text_core_rank = networkx_ranks(lines, window_size)
+    keywords = set()
+    for line in lines:
+        words = line.strip().split()
+        for node in words:
+            if node not in stopword and node in text_core_rank \
+                and len(node) > 1: # not count uni-char words
+                keywords.add((node, text_core_rank[node] * \
+                        text_pagerank[node]))
+    return sorted(keywords, key=itemgetter(1), reverse=True)
+
+def networkx_ranks(lines, window_size):
+    '''Return the (pagerank, core number) dicts of the document graph'''
+    text_graph = nx.Graph()
+    for line in lines:
+        words = line.strip().split()
+        for ind, node in enumerate(words):
+            # compute window boundaries
+            lower = ind - window_size \
+                    if ind - window_size > 0 else 0
+            upper = ind + window_size \
+                    if ind + window_size < len(words) else len(words)
+            for j in range(lower, upper):
+                if j != ind and node != words[j]:
+                    if text_graph.has_edge(node, words[j]):
+                        text_graph[node][words[j]]['weight'] += 1
+                    else:
+                        text_graph.add_edge(node, words[j], weight=1)
+    # textrank method
+    text_pagerank = nx.pagerank(text_graph)
+    # compute core number
+    text_core_rank = nx.core_number(text_graph)
+    return text_pagerank, text_core_rank
+
+def numpy_ranks(lines, window_size):
+    '''networkx_ranks with the array engine of graph_rank.py'''
+    nodes, src, dst, weight = cooccurrence_graph(lines, window_size)
+    ranks = pagerank(len(nodes), src, dst, weight)
+    cores = core_number(len(nodes), src, dst)
+    return (dict(zip(nodes, ranks.tolist())),
+            dict(zip(nodes, cores.tolist())))
+
+def settings_digest(stopword, window_size, engine):
+    '''Hash the settings that the keywords of a document depend on'''
+    digest = hashlib.sha256('{0}\n{1}\n'.format(window_size, engine)
+                            .encode('utf-8'))
+    for word in sorted(stopword):
+        digest.update(word.encode('utf-8') + b'\n')
+    return digest.hexdigest()
+
+def generate_file(doc_file, stopword, window_size, outdir, engine='networkx',
+                  cache_dir=None, settings=None):
+    '''
+    Write the keywords of one (filename, filepath) to "outdir".
+
+    Returns:
+      cached: whether the keywords came from "cache_dir"
     '''
+    filename, filepath = doc_file
+    with open(filepath) as ptv_file:
+        text = ptv_file.read()
+    cache_file = None
+    if cache_dir is not None:
+        digest = hashlib.sha256(settings.encode('utf-8'))
+        digest.update(text.encode('utf-8'))
+        cache_file = os.path.join(cache_dir, digest.hexdigest())
+        if os.path.isfile(cache_file):
+            with open(cache_file) as cached:
+                output = cached.read()
+            with open(os.path.join(outdir, filename), 'w') as out:
+                out.write(output)
+            return True
+    output = ''.join('{0} {1}\n'.format(k[0], k[1]) for k in
+                     doc_keyterms(text.split('\n'), stopword,
+                                  window_size, engine))
+    with open(os.path.join(outdir, filename), 'w') as out:
+        out.write(output)
+    if cache_file is not None:
+        # write then rename, so other workers never read a partial entry
+        with open(cache_file + '.{0}.tmp'.format(os.getpid()), 'w') as out:
+            out.write(output)
+        os.replace(cache_file + '.{0}.tmp'.format(os.getpid()), cache_file)
+    return False
+
+def main(docopt_args):
     stopword = read_stopwords(docopt_args['<stopword>'])
     window_size = int(docopt_args['<window-size>'])
-
-    for filename, filepath in walk_all_files(docopt_args['<doc-dir>']):
-        text_graph = nx.Graph()
-        with open(filepath) as ptv_file:
-            for line in ptv_file:
-                words = line.strip().split()
-                for ind, node in enumerate(words):
-                    # compute window boundaries
-                    lower = ind - window_size \
-                            if ind - window_size > 0 else 0
-                    upper = ind + window_size \
-                            if ind + window_size < len(words) else len(words)
-                    for j in range(lower, upper):
-                        if j != ind and node != words[j]:
-                            if text_graph.has_edge(node, words[j]):
-                                text_graph[node][words[j]]['weight'] += 1
-                            else:
-                                text_graph.add_edge(node, words[j], weight=1)
-            # textrank method
-            text_pagerank = nx.pagerank(text_graph)
-            # compute core number
-            text_core_rank = nx.core_number(text_graph)
-        with open(filepath) as ptv_file, \
-             open(os.path.join(docopt_args['<outdir>'], filename), 'w') as out:
-            keywords = set()
-            for line in ptv_file:
-                words = line.strip().split()
-                for node in words:
-                    if node not in stopword and node in text_core_rank \
-                        and len(node) > 1: # not count uni-char words
-                        keywords.add((node, text_core_rank[node] * \
-                                text_pagerank[node]))
-            for k in sorted(keywords, key=itemgetter(1), reverse=True):
-                out.write('{0} {1}\n'.format(k[0], k[1]))
+    engine = docopt_args['--engine']
+    if engine not in ENGINES:
+        raise ValueError('unknown engine {0}, use one of {1}'.format(
+                         engine, ', '.join(ENGINES)))
+    cache_dir = docopt_args['--cache-dir']
+    settings = None
+    if cache_dir is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        settings = settings_digest(stopword, window_size, engine)
+    generate = partial(generate_file, stopword=stopword,
+                       window_size=window_size,
+                       outdir=docopt_args['<outdir>'], engine=engine,
+                       cache_dir=cache_dir, settings=settings)
+    doc_files = list(walk_all_files(docopt_args['<doc-dir>']))
+    workers = int(docopt_args['--workers'])
+    if workers > 1:
+        with Pool(workers) as pool:
+            cached = list(pool.imap_unordered(generate, doc_files,
+                                              chunksize=4))
+    else:
+        cached = [generate(doc_file) for doc_file in doc_files]
+    if cache_dir is not None:
+        print('{0} documents processed, {1} reused from the cache'.format(
+              len(cached) - sum(cached), sum(cached)))
 
 if __name__ == '__main__':
     main(docopt(__doc__))
@@ -0,0 +1,190 @@
+# File name: keyword_store.py
+# python version: 3.5+
+# Description:
+#   Compiled keyword store that keeps the keyterms of every document as
+#   keyword-ID and score arrays, in place of the keyterm directory.
+'''Keyword store
+
+A keyword store is one array bundle (see util.create_arrays) with the
+attributes {"format": "iir-keywords", "version": 2} and these arrays:
+
+  word_bytes   uint8   (B,)    UTF-8 bytes of the sorted keyword vocabulary
+  word_offsets int64   (W+1,)  keyword ID w is
+                               word_bytes[word_offsets[w]:word_offsets[w+1]]
+  doc_names    <U*     (D,)    sorted document file names
+  offsets      int64   (D+1,)  keywords of document d are
+                               [offsets[d], offsets[d+1])
+  keyword_ids  int32   (K,)    keyword IDs of each document, in file order
+  scores       float32 (K,)    keyword scores, aligned with keyword_ids
+
+Keyterm files list their keywords from the highest score down, and that
+order is kept, so the top-N keywords of a document are the first N of its
+range. Opening a store only maps the file; keywords are turned back into
+(keyword, score) lists only for the documents asked for.
+'''
+import numpy as np
+from itertools import chain
+from util import is_array_bundle
+from util import load_arrays
+from util import read_keyword_dir
+from util import save_arrays
+from util import string_arrays
+from util import StringArray
+from util import walk_all_files
+from doc_store import unique_words
+
+KEYWORDS_FORMAT = 'iir-keywords'
+KEYWORDS_VERSION = 2
+
+class KeywordStore:
+    '''
+    Keyword-ID and score arrays of every document with an offsets table.
+    It reads like the {filename: [(keyword, score)]} dict of
+    util.read_keyword_dir.
+    '''
+    def __init__(self, arrays, top_n=None):
+        self.arrays = arrays
+        self.words = StringArray(arrays['word_bytes'],
+                                 arrays['word_offsets'])
+        self.doc_names = arrays['doc_names']
+        self.offsets = arrays['offsets']
+        self.keyword_ids = arrays['keyword_ids']
+        self.scores = arrays['scores']
+        # at most "top_n" keywords are read per document, all if None
+        self.top_n = top_n
+
+    @classmethod
+    def load(cls, filename, top_n=None):
+        '''Memory-map a keyword store file'''
+        arrays, attrs = load_arrays(filename)
+        if attrs.get('format') != KEYWORDS_FORMAT or \
+                attrs.get('version') != KEYWORDS_VERSION:
+            raise ValueError('{0} is not a version {1} keyword store'.format(
+                             filename, KEYWORDS_VERSION))
+        return cls(arrays, top_n)
+
+    def __len__(self):
+        return len(self.doc_names)
+
+    def __iter__(self):
+        return iter(self.doc_names.tolist())
+
+    def __contains__(self, doc):
+        return self.doc_id(doc) >= 0
+
+    def __getitem__(self, doc):
+        return self.keywords(doc)
+
+    def keys(self):
+        return self.doc_names.tolist()
+
+    def items(self):
+        '''Yield (filename, [(keyword, score)]) of every document'''
+        for doc in self:
+            yield doc, self.keywords(doc)
+
+    def doc_id(self, doc):
+        '''Return the position of file name "doc", or -1 if it is absent'''
+        pos = int(np.searchsorted(self.doc_names, doc))
+        if pos < len(self.doc_names) and self.doc_names[pos] == doc:
+            return pos
+        return -1
+
+    def keyword_arrays(self, doc, top_n=None):
+        '''
+        Return the keyword IDs and scores of the top "top_n" keywords of
+        "doc", or of the store default when "top_n" is None.
+        '''
+        pos = self.doc_id(doc)
+        if pos < 0:
+            raise KeyError(doc)
+        start, end = int(self.offsets[pos]), int(self.offsets[pos + 1])
+        top_n = self.top_n if top_n is None else top_n
+        if top_n is not None:
+            end = min(end, start + top_n)
+        return self.keyword_ids[start:end], self.scores[start:end]
+
+    def keywords(self, doc, top_n=None):
+        '''Return [(keyword, score)] of the top "top_n" keywords of "doc"'''
+        keyword_ids, scores = self.keyword_arrays(doc, top_n)
+        return list(zip(self.words.take(keyword_ids), scores.tolist()))
+
+def load_keywords(keyword_path, thres=10000):
+    '''
+    Load keywords for each document from a keyword store file, which is
+    memory-mapped, or from a keyterm directory, which is parsed.
+
+    Args:
+      keyword_path: keyword store file or keyterm directory
+      thres(default=10000): keep keywords up to line "thres" of each
+        keyterm file, as util.read_keyword_dir
+    Returns:
+      keyword_dict: filename to [(keyword, score)] mapping
+    '''
+    if is_array_bundle(keyword_path):
+        return KeywordStore.load(keyword_path, top_n=thres + 1)
+    return read_keyword_dir(keyword_path, thres)
+
+def keyword_store_arrays(keyword_dir, dtype=np.float32, max_keywords=None):
+    '''
+    Read every keyterm file in "keyword_dir" into keyword store arrays.
+
+    Args:
+      keyword_dir: keyterm directory, one "keyword score" line per keyword
+      dtype(default=np.float32): dtype of the stored scores
+      max_keywords(default=None): keep only this many keywords per document
+    '''
+    return pack_keyword_store(read_keyterm_files(walk_all_files(keyword_dir),
+                                                 max_keywords), dtype)
+
+def read_keyterm_files(files, max_keywords=None):
+    '''
+    Read a list of (filename, filepath) of keyterm files into a file name
+    to (keywords, scores) dict, keeping at most "max_keywords" per file.
+    '''
+    keywords_dict = {}
+    for filename, filepath in files:
+        keywords = []
+        scores = []
+        with open(filepath) as keyfile:
+            for ind, line in enumerate(keyfile):
+                if max_keywords is not None and ind >= max_keywords:
+                    break
+                keyword, score = line.strip().split()
+                keywords.append(keyword)
+                scores.append(float(score))
+        keywords_dict[filename] = (keywords, scores)
+    return keywords_dict
+
+def pack_keyword_store(keywords_dict, dtype=np.float32):
+    '''
+    Return the keyword store arrays of a file name to (keywords, scores)
+    dict, with the scores stored as "dtype".
+    '''
+    doc_names = sorted(keywords_dict)
+    offsets = np.zeros(len(doc_names) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(keywords_dict[doc][0])
+                             for doc in doc_names])
+    words, keyword_ids = unique_words(list(chain.from_iterable(
+        keywords_dict[doc][0] for doc in doc_names)))
+    scores = np.fromiter(chain.from_iterable(keywords_dict[doc][1]
+                                             for doc in doc_names),
+                         dtype=dtype, count=offsets[-1])
+    word_bytes, word_offsets = string_arrays(words)
+    return {'word_bytes': word_bytes,
+            'word_offsets': word_offsets,
+            'doc_names': np.array(doc_names, dtype=np.str_),
+            'offsets': offsets,
+            'keyword_ids': keyword_ids,
+            'scores': scores}
+
+def write_keyword_store(filename, keyword_dir, dtype=np.float32,
+                        max_keywords=None):
+    '''Write the keyterms of "keyword_dir" as a keyword store file'''
+    save_keyword_store(filename, keyword_store_arrays(keyword_dir, dtype,
+                                                      max_keywords))
+
+def save_keyword_store(filename, arrays):
+    '''Write keyword store arrays as a keyword store file'''
+    save_arrays(filename, arrays,
+                {'format': KEYWORDS_FORMAT, 'version': KEYWORDS_VERSION})
@@ -0,0 +1,201 @@
+# File name: ranking.py
+# python version: 3.5+
+# Description:
+#   Lazy, page-addressable ranking results. A ranking is only sorted as
+#   far as callers read it.
+'''Ranking views
+
+Rankings come from a source, which returns the sorted prefix of a given
+size as (doc_ids, scores) arrays and tells which doc IDs it ranks. Equal
+scores are ordered by doc ID, as in scoring.rank_documents.
+  SortedRanking  a ranking that is already sorted, e.g. top-k results
+  ScoreRanking   dense scores of some candidates, sorted lazily
+  MergedRanking  a base ranking with some documents rescored, merged lazily
+RankingView turns a source into a read-only sequence of (doc, score) pairs.
+'''
+import numpy as np
+from scoring import top_documents
+from scoring import merge_rankings
+
+class SortedRanking:
+    '''Source over doc IDs that are already sorted'''
+    def __init__(self, doc_ids, scores):
+        self.doc_ids = doc_ids
+        self.scores = scores
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def prefix(self, size):
+        return self.doc_ids[:size], self.scores[:size]
+
+    def contains(self, doc_ids):
+        return np.isin(doc_ids, self.doc_ids)
+
+class ScoreRanking:
+    '''Source over dense scores, partially sorted on demand'''
+    def __init__(self, scores, candidates):
+        '''
+        Args:
+          scores: dense score array indexed by doc ID
+          candidates: sorted doc IDs to rank
+        '''
+        self.scores = scores
+        self.candidates = candidates
+        self.doc_ids = candidates[:0]
+
+    def __len__(self):
+        return len(self.candidates)
+
+    def prefix(self, size):
+        if size > len(self.doc_ids) and \
+                len(self.doc_ids) < len(self.candidates):
+            # grow geometrically, so reading the whole ranking page by page
+            # costs a few partial sorts and not one per page
+            size = max(size, 2 * len(self.doc_ids))
+            if size >= len(self.candidates) // 2:
+                size = None
+            self.doc_ids = top_documents(self.scores, self.candidates, size)
+        doc_ids = self.doc_ids[:size]
+        return doc_ids, self.scores[doc_ids]
+
+    def contains(self, doc_ids):
+        pos = np.searchsorted(self.candidates, doc_ids)
+        pos[pos == len(self.candidates)] = 0
+        return (self.candidates[pos] == doc_ids) if len(self.candidates) \
+            else np.zeros(len(doc_ids), dtype=bool)
+
+class MergedRanking:
+    '''
+    Source over a base ranking in which the "touched" documents got new
+    scores. The others keep their base order, so the prefix is a merge of
+    the base prefix without the touched documents and the touched ones.
+    '''
+    def __init__(self, base, touched, touched_ids, touched_scores, length):
+        '''
+        Args:
+          base: source of the base ranking
+          touched: boolean mask of the rescored doc IDs
+          touched_ids: rescored doc IDs, sorted by their new scores
+          touched_scores: their new scores
+          length: number of documents in the merged ranking
+        '''
+        self.base = base
+        self.touched = touched
+        self.touched_ids = touched_ids
+        self.touched_scores = touched_scores
+        self.length = length
+        self.doc_ids = touched_ids[:0]
+        self.scores = touched_scores[:0]
+
+    def __len__(self):
+        return self.length
+
+    def prefix(self, size):
+        if size > len(self.doc_ids) and len(self.doc_ids) < self.length:
+            size = max(size, 2 * len(self.doc_ids))
+            base_size = size
+            while True:
+                base_ids, base_scores = self.base.prefix(base_size)
+                kept = ~self.touched[base_ids]
+                if np.count_nonzero(kept) >= size or \
+                        len(base_ids) == len(self.base):
+                    break
+                base_size *= 2
+            doc_ids, scores = merge_rankings(
+                base_ids[kept][:size], base_scores[kept][:size],
+                self.touched_ids[:size], self.touched_scores[:size])
+            self.doc_ids, self.scores = doc_ids[:size], scores[:size]
+        return self.doc_ids[:size], self.scores[:size]
+
+    def contains(self, doc_ids):
+        return self.touched[doc_ids] | self.base.contains(doc_ids)
+
+class RankingView:
+    '''
+    Ranking as a read-only sequence of (doc, score) pairs that skips the
+    excluded documents.
+
+    Nothing is copied or sorted up front: the source is sorted and filtered
+    chunk by chunk, only as far as the caller reads. Iteration goes page by
+    page, and to_list() materializes the whole ranking.
+    '''
+    def __init__(self, source, doc_names, exclude=(), page_size=10):
+        '''
+        Args:
+          source: ranking source, see the module docstring
+          doc_names: maps a doc ID to its file name
+          exclude(default=()): doc IDs to skip
+          page_size(default=10): number of results on one page
+        '''
+        self.source = source
+        self.doc_names = doc_names
+        self.exclude = np.array(sorted(exclude), dtype=np.int64)
+        self.page_size = page_size
+        # sorted doc IDs and scores that survive the filter, found so far
+        self.doc_ids = np.zeros(0, dtype=np.int64)
+        self.scores = np.zeros(0)
+        self.scanned = 0
+        self.length = None
+
+    def __extend(self, size):
+        '''Filter until "size" results are kept or the ranking ends'''
+        step = max(size - len(self.doc_ids), self.page_size)
+        while len(self.doc_ids) < size and self.scanned < len(self.source):
+            doc_ids, scores = self.source.prefix(self.scanned + step)
+            doc_ids = doc_ids[self.scanned:]
+            scores = scores[self.scanned:]
+            self.scanned += len(doc_ids)
+            if len(self.exclude):
+                kept = ~np.isin(doc_ids, self.exclude)
+                doc_ids, scores = doc_ids[kept], scores[kept]
+            self.doc_ids = np.concatenate((self.doc_ids, doc_ids))
+            self.scores = np.concatenate((self.scores, scores))
+            step *= 2
+
+    def __pairs(self, doc_ids, scores):
+        doc_names = self.doc_names
+        return [(doc_names[doc_id], score) for doc_id, score in
+                zip(doc_ids.tolist(), scores.tolist())]
+
+    def __len__(self):
+        if self.length is None:
+            self.length = len(self.source) - int(np.count_nonzero(
+                self.source.contains(self.exclude)))
+        return self.length
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            # range() keeps the meaning of the normalized indices, which a
+            # slice does not for negative steps
+            positions = np.arange(*key.indices(len(self)))
+            if len(positions) == 0:
+                return []
+            self.__extend(int(positions.max()) + 1)
+            return self.__pairs(self.doc_ids[positions],
+                                self.scores[positions])
+        if key < 0:
+            key += len(self)
+        self.__extend(key + 1)
+        if not 0 <= key < len(self.doc_ids):
+            raise IndexError('ranking index out of range')
+        return self.__pairs(self.doc_ids[key:key + 1],
+                            self.scores[key:key + 1])[0]
+
+    def page(self, number):
+        '''Return the (doc, score) pairs on page "number", counted from 0'''
+        return self[number * self.page_size:(number + 1) * self.page_size]
+
+    def __iter__(self):
+        number = 0
+        while True:
+            page = self.page(number)
+            for pair in page:
+                yield pair
+            if len(page) < self.page_size:
+                return
+            number += 1
+
+    def to_list(self):
+        '''Materialize the whole ranking as a list of (doc, score)'''
+        return self[:]
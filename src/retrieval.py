@@ -11,54 +11,263 @@
 #   support the simulation.
 '''Retrieval system'''
 import os
-import pickle
+import numpy as np
 from math import log2
-from copy import deepcopy
 from operator import itemgetter
-from collections import defaultdict
 from util import *
+from scoring import LangScorer
+from scoring import load_index
+from scoring import TermCache
+from doc_store import DocStore
+from doc_store import DictDocStore
+from doc_store import read_doc_files
+from keyword_store import load_keywords
+from segment_index import is_segmented_index
+from segment_index import merge_in_background
+from segment_index import read_manifest
+from segment_index import SegmentDocStore
+from segment_index import SegmentedIndex
+from segment_index import SegmentKeywords
+from ranking import MergedRanking
+from ranking import RankingView
+from ranking import ScoreRanking
+from ranking import SortedRanking
 
 class RetrievalSystem:
     '''
-    This class implements language model retrieval with Dirichlet prior
+    This class implements language model retrieval with Dirichlet prior.
+    It only holds read-only data; interactive retrieval goes through the
+    RetrievalSession objects returned by new_session().
     '''
     def __init__(self,
                  index_file,    # inverted index
                  doclen_file,   # to enable document length normalization
                  bglm_file,     # statistic to enable background smoothing
+                                # (both unused with a binary index)
                  keyword_dirname, # to support "feedback by keyword" action
+                                # (directory or keyword store file)
                  doc_dir,        # to support "feedback by document" action
+                                # (directory or document store file)
                  mu=1000,       # Dirichlet prior parameter
                  char_weight=1.0,   # character-based retrieval weight
-                 bichar_weight=1.0): # bi-character-based retrieval weight
+                 bichar_weight=1.0, # bi-character-based retrieval weight
+                 top_k=None,    # only rank the top-k documents if given
+                 cache_bytes=256 * 2**20): # term score cache, 0 to disable
         # read all relevant files
-        # TODO: Although pickle is convienent, it is not space efficient.
-        #   What's worse, you should read the source code to figure out the
-        #   representation of the object.
-        #   Change these to some other serial object.
-        self.index_dict = pickle_load(index_file)
-        self.doclen_dict = pickle_load(doclen_file)
-        self.bglm_dict = pickle_load(bglm_file)
-        self.keyword_dict = read_keyword_dir(keyword_dirname)
+        # "index_file" is either a binary index (see binary_index.py), which
+        # is memory-mapped and already holds doclen and bglm, a segmented
+        # index directory (see segment_index.py), which can be refreshed
+        # when documents are added or deleted, or a pickled index that comes
+        # with the pickled doclen and bglm files.
+        self.index_file = index_file
+        self.doclen_file = doclen_file
+        self.bglm_file = bglm_file
+        self.keyword_dirname = keyword_dirname
         # initialize parameters
         self.mu = mu
         self.char_weight = char_weight;
         self.bichar_weight = bichar_weight
-        
-        # record current ranking list
-        ## this should be changed in the need of parallel processing
-        self.ranking_list = None
-        self.score_dict = None
-        self.queries = None
+        self.cache_bytes = cache_bytes
+        self.top_k = top_k
+        self.doc_dir = doc_dir
+        self.merge_thread = None
         # after we identify the desired document ID, we need to retrieve the
         # corresponding documents from the disk
-        # but to accelerate the whole process, we load all data in 
-        self.doc_dict = {}
-        for filename, filepath in walk_all_files(doc_dir):
-            self.doc_dict[filename] = []
-            with open(filepath) as docfile:
-                for line in docfile:
-                    self.doc_dict[filename].extend(line.strip().split())
+        # "doc_dir" is either a document store file (see doc_store.py), which
+        # is memory-mapped and read on demand, or a directory, which is read
+        # into word lists
+        if is_array_bundle(doc_dir):
+            self.base_docs = DocStore.load(doc_dir)
+        else:
+            self.base_docs = DictDocStore.from_dir(doc_dir)
+        # a keyword store file (see keyword_store.py) is memory-mapped and
+        # read per document, a keyterm directory is parsed at once
+        self.base_keywords = load_keywords(keyword_dirname)
+        # Both are read once. Documents a segmented index adds later come
+        # with document and keyword stores of their segment; those of
+        # segments without stores are read from the directories, and only
+        # them, on refresh().
+        self.extra_docs = DictDocStore({})
+        self.extra_keywords = {}
+        # segment files whose documents are covered by the above
+        self.seen_segments = None
+        self.__load()
+        # Everything above is read-only after loading, except that
+        # refresh() swaps in a newly loaded index. The interactive state
+        # of each user lives in a RetrievalSession, so one loaded system can
+        # serve many users from threads, or from forked processes that share
+        # these structures copy-on-write.
+
+    def __load(self):
+        '''Load the index and documents, and build a scorer over them'''
+        index = load_index(self.index_file, self.doclen_file, self.bglm_file)
+        if index.impact_mu is not None and index.impact_mu != self.mu:
+            raise ValueError('{0} holds impacts for mu={1}, not mu={2}'
+                             .format(self.index_file, index.impact_mu,
+                                     self.mu))
+        # the same characters are scored over and over across queries and
+        # feedback rounds, so keep their score vectors around
+        term_cache = TermCache(self.cache_bytes) if self.cache_bytes \
+            else None
+        doc_store = self.base_docs
+        keyword_dict = self.base_keywords
+        if isinstance(index, SegmentedIndex):
+            self.__read_new_segments(index)
+            doc_store = SegmentDocStore(index, [self.extra_docs,
+                                                self.base_docs])
+            keyword_dict = SegmentKeywords(index, [self.extra_keywords,
+                                                   self.base_keywords])
+        self.index = index
+        self.term_cache = term_cache
+        self.doc_store = doc_store
+        self.keyword_dict = keyword_dict
+        self.scorer = LangScorer(index, self.mu, self.char_weight,
+                                 self.bichar_weight, term_cache)
+        # sessions take the scorer, which holds the index, and the documents
+        # and keywords that go with it in one read
+        self.snapshot = (self.scorer, doc_store, keyword_dict)
+
+    def __read_new_segments(self, index):
+        '''
+        Read the documents and keyterms of the segments of "index" that
+        are new since the last load, and that neither their stores nor the
+        ones read so far hold, from the directories.
+        '''
+        if self.seen_segments is None:
+            # the first load reads the whole directories
+            self.seen_segments = set(index.files)
+            return
+        docs = []
+        keyword_docs = []
+        for pos, filename in enumerate(index.files):
+            if filename in self.seen_segments:
+                continue
+            doc_store = index.doc_stores[pos]
+            keyword_store = index.keyword_stores[pos]
+            for doc in index.segment_docs(pos):
+                if (doc_store is None or doc not in doc_store) and \
+                        doc not in self.extra_docs and \
+                        doc not in self.base_docs:
+                    docs.append(doc)
+                if (keyword_store is None or doc not in keyword_store) and \
+                        doc not in self.extra_keywords and \
+                        doc not in self.base_keywords:
+                    keyword_docs.append(doc)
+        if docs:
+            if is_array_bundle(self.doc_dir):
+                raise ValueError('{0} does not hold the added document {1}, '
+                                 'which has no document store'.format(
+                                 self.doc_dir, docs[0]))
+            words_dict = dict(self.extra_docs.words_dict)
+            words_dict.update(read_doc_files(
+                [(doc, os.path.join(self.doc_dir, doc)) for doc in docs]))
+            self.extra_docs = DictDocStore(words_dict)
+        if keyword_docs and not is_array_bundle(self.keyword_dirname):
+            # documents without keyterm files have no keywords, as when
+            # the directory is read at once
+            keyword_files = [(doc, os.path.join(self.keyword_dirname, doc))
+                             for doc in keyword_docs]
+            keyword_dict = dict(self.extra_keywords)
+            keyword_dict.update(read_keyword_files(
+                [(doc, path) for doc, path in keyword_files
+                 if os.path.isfile(path)]))
+            self.extra_keywords = keyword_dict
+        self.seen_segments.update(index.files)
+
+    def refresh(self, max_segments=None):
+        '''Reload a segmented index after documents were added or deleted
+
+        Sessions keep the index, documents and keywords they started their
+        query with, and new queries use the new ones. The documents and
+        keyterms of the added segments come from their stores (see
+        segment_index.add_documents), or else from the directories, which
+        are read only for those documents.
+
+        Args:
+          max_segments(default=None): if given and the index has more
+            segments, merge them in a background thread; the merged index
+            is picked up by a later refresh
+        Returns:
+          reloaded: whether the index changed
+        Raises:
+          ValueError: if an added document has no document store and the
+            documents come from a store file
+        '''
+        if not is_segmented_index(self.index_file):
+            return False
+        reloaded = read_manifest(self.index_file)['generation'] != \
+            self.index.generation
+        if reloaded:
+            self.__load()
+        if max_segments is not None and \
+                len(self.index.segments) > max_segments and \
+                (self.merge_thread is None or
+                 not self.merge_thread.is_alive()):
+            self.merge_thread = merge_in_background(self.index_file,
+                                                    max_segments)
+        return reloaded
+
+    def new_session(self, page_size=10):
+        '''Return a new RetrievalSession backed by this system'''
+        return RetrievalSession(self, page_size)
+
+    def get_actions(self):
+        '''Return all available actions'''
+        return ['return_by_doc', 'return_by_keyterm']
+
+    def lang_score(self, q):
+        '''
+        Args:
+          q: query, which is a word list
+        Returns:
+          scores: dense score array indexed by doc ID
+          matched: boolean mask of the documents that share a term with "q"
+        '''
+        return self.scorer.score(self.scorer.query_terms(q))
+
+    def batch_query(self, queries, top_k=100, batch_size=64):
+        '''Score a list of queries together
+
+        Unlike RetrievalSession.query, this does not touch any session
+        state, so it suits precomputing rankings for a whole query file.
+
+        Args:
+          queries: list of queries, and each query is also a list
+          top_k(default=100): ranking length per query, None for all
+          batch_size(default=64): number of queries scored at once
+        Returns:
+          ranking_lists: list of [(doc, score)] per query
+        '''
+        scorer = self.scorer
+        doc_names = scorer.index.doc_names
+        term_lists = [scorer.query_terms(q) for q in queries]
+        return [[(doc_names[doc_id], score) for doc_id, score in
+                 zip(doc_ids.tolist(), scores.tolist())]
+                for doc_ids, scores in
+                scorer.batch_top_k(term_lists, top_k, batch_size)]
+
+class RetrievalSession:
+    '''
+    Interactive state of one user on a shared RetrievalSystem: the current
+    query, its ranking list and the feedback given so far.
+    '''
+    def __init__(self, system, page_size=10):
+        self.system = system
+        # scorer, index, documents and keywords of the current query, which
+        # stay the same until the next query even if the system is
+        # refreshed meanwhile
+        self.scorer, self.doc_store, self.keyword_dict = system.snapshot
+        # number of results shown on one screen
+        self.page_size = page_size
+        # record current ranking list, a lazy RankingView, and its source
+        self.ranking_list = None
+        self.ranking_source = None
+        self.queries = None
+        # scores and ranking of the query itself, kept for the life of the
+        # query so that each feedback round only adds its own scores
+        self.base_scores = None
+        self.base_matched = None
+        self.base_ranking = None
         # Avoid redundant feedback, and accumulate information.
         # If add another action, this should also fix.
         self.past_feedback_keyword = set()
@@ -76,37 +285,51 @@ class RetrievalSystem:
           q: input query, which is a list
           retrieval_method(default=lang): retrieval model
         Returns:
-          ranking_list: retrieval result
+          ranking_list: retrieval result, a RankingView that is only sorted
+            as far as it is read
         '''
         self.past_feedback_doc = set()
         self.past_feedback_keyword = set()
         self.queries = q
+        self.scorer, self.doc_store, self.keyword_dict = self.system.snapshot
         if retrieval_method == 'lang':
-            score_dict = self.__lang_score(q)
-        self.score_dict = score_dict
-        self.ranking_list = sorted(score_dict.items(), key=itemgetter(1),
-                                   reverse=True)
-        return self.ranking_list
+            if self.system.top_k is not None:
+                return self.__set_top_k(self.scorer.query_terms(q))
+            self.__set_base(q)
+        return self.__set_ranking(self.base_ranking)
 
     # the followings are support feedback actions
     def get_actions(self):
         '''Return all available actions'''
-        return ['return_by_doc', 'return_by_keyterm']
+        return self.system.get_actions()
 
     def lang_score_feedback(self, q, feedback_doc, weight=0.05):
-        score_dict = self.__lang_score(q)
-        feedback_dict = self.__lang_score(feedback_doc)
-        new_score_dict = self.__merge_score(score_dict, feedback_dict, weight)
-        self.score_dict = new_score_dict
-        self.ranking_list = sorted(new_score_dict.items(), key=itemgetter(1),
-                                   reverse=True)
-        return self.ranking_list
+        scorer = self.scorer
+        if self.system.top_k is not None:
+            return self.__set_top_k(scorer.query_terms(q),
+                    scorer.query_terms(feedback_doc), weight)
+        if self.base_scores is None or q != self.queries:
+            self.__set_base(q)
+        feedback_scores, touched = scorer.score(
+                scorer.query_terms(feedback_doc))
+        # Documents that the feedback does not touch keep their base score
+        # and their relative order, so only the touched ones are sorted and
+        # merged back into the base ranking, as far as it is read.
+        touched_ids = np.flatnonzero(touched)
+        touched_scores = self.base_scores[touched_ids] + \
+                         weight * feedback_scores[touched_ids]
+        order = np.lexsort((touched_ids, -touched_scores))
+        length = len(self.base_ranking) + len(touched_ids) - \
+                 int(np.count_nonzero(self.base_matched[touched_ids]))
+        return self.__set_ranking(MergedRanking(self.base_ranking, touched,
+                touched_ids[order], touched_scores[order], length))
 
     def request_feedback(self, action):
         '''Use the necessary input according to the action
         '''
         # TODO: Add more actions here.
-        # TODO: Customize to the screen size.
+        # Ranking lists come back as RankingViews of "page_size" results
+        # per page.
         if action == 'return_by_doc':
             # Give users the ranking list.
             return self.__return_by_doc_request()
@@ -119,18 +342,17 @@ class RetrievalSystem:
         if action == 'return_by_doc':
             self.past_feedback_doc.add(feedback_input[0])
             return self.lang_score_feedback(self.queries,
-                                [''.join(self.doc_dict[feedback_input[0]])])
+                        [self.doc_store.text(feedback_input[0])])
         elif action == 'return_by_keyterm':
             self.past_feedback_keyword.add(feedback_input)
             return self.lang_score_feedback(self.queries, [feedback_input])
 
     def __return_by_doc_request(self):
-        '''Return whole ranking list'''
-        feedback_doc_dict = deepcopy(self.score_dict)
-        for doc_id in self.past_feedback_doc:
-            del feedback_doc_dict[doc_id]
-        return sorted(feedback_doc_dict.items(), key=itemgetter(1),
-                      reverse=True)
+        '''Return whole ranking list, without the documents fed back'''
+        index = self.scorer.index
+        exclude = [index.doc_id(doc) for doc in self.past_feedback_doc]
+        return RankingView(self.ranking_source, index.doc_names, exclude,
+                           self.page_size)
 
     def __return_by_keyterm_request(self, num_docs=30, num_keys=50):
         '''
@@ -140,61 +362,44 @@ class RetrievalSystem:
         rankset = set(x[0] for x in self.ranking_list[:num_docs])
         # doc_num may be less than num_docs
         doc_num = len(rankset)
-        counter = defaultdict(int)
-        for doc in rankset:
-            # Count each word in each document only once.
-            doc_word = set(self.doc_dict[doc])
-            for word in doc_word:
-                counter[word] += 1
         # Load all the keywords contained in the top documents.
         keywords = []
         for doc in rankset:
             keywords.extend(self.keyword_dict[doc])
         # keyword ranking according their textrank * main-core score
         keyrank = [x[0] for x in sorted(keywords, key=itemgetter(1),
-                                        reverse=True)]
+                                        reverse=True)][:num_keys]
+        # Count each word in each document only once, with the precomputed
+        # document vocabularies.
+        doc_freq = self.doc_store.doc_frequencies(rankset, keyrank)
         high_entropy_keyword = []
         # Remove keywords that are counted multiple times.
         keyword_set = set()
-        for keyword in keyrank[:num_keys]:
-            if len(high_entropy_keyword) > num_keys:
-                break
-            if keyword in counter and keyword not in keyword_set and \
+        for keyword, count in zip(keyrank, doc_freq.tolist()):
+            if count > 0 and keyword not in keyword_set and \
                         keyword not in self.past_feedback_keyword:
                 keyword_set.add(keyword)
                 high_entropy_keyword.append((keyword,
-                    counter[keyword] / doc_num * log2 (
-                    doc_num / counter[keyword])))
+                    count / doc_num * log2(doc_num / count)))
         sorted_high_entropy_key = [x[0] for x in sorted(
                 high_entropy_keyword, key=itemgetter(1), reverse=True)]
         return sorted_high_entropy_key
 
-    def __merge_score(self, dict1, dict2, weight=0.1):
-        for k, v in dict2.items():
-            dict1[k] += weight * v
-        return dict1
+    def __set_base(self, q):
+        '''Score the query and keep its scores and ranking'''
+        self.base_scores, self.base_matched = self.scorer.score(
+                self.scorer.query_terms(q))
+        self.base_ranking = ScoreRanking(self.base_scores,
+                                         np.flatnonzero(self.base_matched))
 
-    def __lang_score(self, q):
-        '''
-        Args:
-          q: query, which is a word list
-        Returns:
-          score_dict: a dict with key-value pair: (doc-id, score)
-        '''
-        score_dict = defaultdict(float)
-        mu = self.mu
-        for text in q: # loop over all words
-            for ch in text: # loop over all characters
-                if ch in self.index_dict:
-                    for doc, tf in self.index_dict[ch]['docs'].items():
-                        score_dict[doc] += self.char_weight * log2(
-                                (mu + tf / self.bglm_dict[ch]) / \
-                                (mu + self.doclen_dict[doc]))
-            for i in range(1, len(text)): # loop over all bi-characters
-                bichar = text[i-1] + text[i]
-                if bichar in self.index_dict:
-                    for doc, tf in self.index_dict[bichar]['docs'].items():
-                        score_dict[doc] += self.bichar_weight * log2(
-                                (mu + tf / self.bglm_dict[bichar]) / \
-                                (mu + self.doclen_dict[doc]))
-        return score_dict
+    def __set_ranking(self, source):
+        '''Record the ranking list of a ranking source'''
+        self.ranking_source = source
+        self.ranking_list = RankingView(source, self.scorer.index.doc_names,
+                                        page_size=self.page_size)
+        return self.ranking_list
+
+    def __set_top_k(self, terms, feedback_terms=(), weight=0.0):
+        '''Record the top-k ranking list of the weighted terms'''
+        return self.__set_ranking(SortedRanking(*self.scorer.top_k(
+                terms, self.system.top_k, feedback_terms, weight)))
@@ -0,0 +1,365 @@
+# File name: scoring.py
+# python version: 3.5+
+# Description:
+#   Term-at-a-time scoring engine for the Dirichlet-prior language model.
+#   Postings are kept as integer doc-ID / tf NumPy arrays, and every term
+#   adds its contribution to a dense score array in one vectorized step.
+'''Vectorized scoring engine'''
+import numpy as np
+from collections import defaultdict
+from util import ByteLRUCache
+from util import is_array_bundle
+from util import pickle_load
+from binary_index import BinaryIndex
+from binary_index import find_postings
+from segment_index import SegmentedIndex
+from segment_index import is_segmented_index
+
+def load_index(index_file, doclen_file=None, bglm_file=None):
+    '''
+    Open a binary index, a segmented index directory, or the pickled index,
+    doclen and bglm dicts created by create_inverted_index.py,
+    calc_doc_len.py and create_bg_lm.py.
+    '''
+    if is_array_bundle(index_file):
+        return BinaryIndex(index_file)
+    if is_segmented_index(index_file):
+        return SegmentedIndex(index_file)
+    return DictIndex(pickle_load(index_file), pickle_load(doclen_file),
+                     pickle_load(bglm_file))
+
+class DictIndex:
+    '''
+    Array view over the pickled index, doclen and bglm dicts.
+
+    Documents are numbered by their sorted file names, and each posting list
+    is converted to (doc_ids, tfs) arrays the first time it is used. At the
+    same time we record the tf and document length ranges of the posting
+    list, which bound the score a term can contribute. Both are stored in
+    one dict entry, so threads that share the index never see one without
+    the other; two threads may convert the same list at once, and the
+    second result simply replaces the equal first one.
+    '''
+    # no precomputed impacts, see binary_index.py
+    impact_mu = None
+
+    def __init__(self, index_dict, doclen_dict, bglm_dict):
+        self.index_dict = index_dict
+        self.bglm_dict = bglm_dict
+        self.doc_names = sorted(doclen_dict)
+        self.doc2id = {doc: ind for ind, doc in enumerate(self.doc_names)}
+        self.doclen = np.array([doclen_dict[doc] for doc in self.doc_names],
+                               dtype=np.float64)
+        self.num_docs = len(self.doc_names)
+        # token -> (doc_ids, tfs, stats)
+        self.posting_entries = {}
+
+    def __contains__(self, token):
+        return token in self.index_dict
+
+    def __entry(self, token):
+        '''Return (doc_ids, tfs, stats) of "token", converting it once'''
+        entry = self.posting_entries.get(token)
+        if entry is None:
+            docs = self.index_dict[token]['docs']
+            doc_ids = np.fromiter((self.doc2id[doc] for doc in docs),
+                                  dtype=np.int32, count=len(docs))
+            tfs = np.fromiter(docs.values(), dtype=np.float64,
+                              count=len(docs))
+            order = np.argsort(doc_ids, kind='stable')
+            doclen = self.doclen[doc_ids]
+            entry = (doc_ids[order], tfs[order],
+                     (tfs.max(), tfs.min(), doclen.min(), doclen.max()))
+            self.posting_entries[token] = entry
+        return entry
+
+    def postings(self, token):
+        '''Return (doc_ids, tfs) of "token", sorted by doc ID'''
+        return self.__entry(token)[:2]
+
+    def postings_at(self, token, doc_ids):
+        '''Return (doc_ids, tfs) of "token" at the sorted "doc_ids"'''
+        return find_postings(*self.postings(token), doc_ids=doc_ids)
+
+    def stats(self, token):
+        '''Return (max_tf, min_tf, min_doclen, max_doclen) of "token"'''
+        return self.__entry(token)[2]
+
+    def bglm(self, token):
+        '''Background probability of "token"'''
+        return self.bglm_dict[token]
+
+    def doc_id(self, doc):
+        '''Return the doc ID of file name "doc"'''
+        return self.doc2id[doc]
+
+class TermCache(ByteLRUCache):
+    '''
+    LRU cache of per-term score vectors, bounded by their size in bytes.
+
+    Keys are (token, mu), so one cache can be shared by scorers with
+    different smoothing. See util.ByteLRUCache for the counters and
+    thread safety.
+    '''
+    def __init__(self, max_bytes=256 * 2**20):
+        super().__init__(max_bytes)
+
+class LangScorer:
+    '''Dirichlet-prior language model scorer over an index view'''
+    def __init__(self, index, mu=1000, char_weight=1.0, bichar_weight=1.0,
+                 cache=None):
+        self.index = index
+        self.mu = mu
+        self.char_weight = char_weight
+        self.bichar_weight = bichar_weight
+        # optional TermCache shared across queries and feedback rounds
+        self.cache = cache
+        # read the scores precomputed in the index if they are for this mu
+        self.use_impacts = index.impact_mu is not None and \
+            index.impact_mu == mu
+
+    def query_terms(self, q, scale=1.0):
+        '''
+        Args:
+          q: query, which is a word list
+          scale(default=1.0): multiply every term weight by this value
+        Returns:
+          terms: list of (token, weight) for every indexed char and bichar
+            occurrence, in the order they appear in "q"
+        '''
+        terms = []
+        for text in q:
+            for ch in text:
+                if ch in self.index:
+                    terms.append((ch, scale * self.char_weight))
+            for i in range(1, len(text)):
+                bichar = text[i-1] + text[i]
+                if bichar in self.index:
+                    terms.append((bichar, scale * self.bichar_weight))
+        return terms
+
+    def term_scores(self, token):
+        '''Return (doc_ids, scores) of "token" before weighting'''
+        if self.cache is not None:
+            cached = self.cache.get((token, self.mu))
+            if cached is not None:
+                return cached
+        mu = self.mu
+        if self.use_impacts:
+            doc_ids, scores = self.index.impacts(token)
+        else:
+            doc_ids, tfs = self.index.postings(token)
+            scores = np.log2((mu + tfs / self.index.bglm(token)) / \
+                             (mu + self.index.doclen[doc_ids]))
+        if self.cache is not None:
+            self.cache.put((token, mu), (doc_ids, scores))
+        return doc_ids, scores
+
+    def score(self, terms):
+        '''
+        Args:
+          terms: list of (token, weight), e.g. from query_terms
+        Returns:
+          scores: dense score array over all documents
+          matched: boolean mask of documents that contain any term
+        '''
+        scores = np.zeros(self.index.num_docs)
+        matched = np.zeros(self.index.num_docs, dtype=bool)
+        for token, weight in terms:
+            doc_ids, term_scores = self.term_scores(token)
+            # doc_ids are unique within a posting list, so fancy-index
+            # accumulation is safe here.
+            scores[doc_ids] += weight * term_scores
+            matched[doc_ids] = True
+        return scores, matched
+
+    def batch_top_k(self, term_lists, k=None, batch_size=64):
+        '''
+        Score many queries together.
+
+        Each batch is a sparse query-term weight matrix multiplied by the
+        term-document score matrix: every distinct term of the batch is
+        scored once and added to the rows of all queries that contain it.
+
+        Args:
+          term_lists: list of term lists, e.g. from query_terms
+          k(default=None): ranking length per query, None for all matches
+          batch_size(default=64): queries per dense (batch, docs) block;
+            a block takes 9 bytes per entry, a float64 score and a bool
+        Returns:
+          rankings: list of (doc_ids, scores) per query, sorted as
+            rank_documents does. Scores equal the one-query path up to
+            floating-point rounding.
+        '''
+        rankings = []
+        for start in range(0, len(term_lists), batch_size):
+            batch = term_lists[start:start + batch_size]
+            # query-term matrix, stored column by column
+            columns = defaultdict(lambda: defaultdict(float))
+            for row, terms in enumerate(batch):
+                for token, weight in terms:
+                    columns[token][row] += weight
+            scores = np.zeros((len(batch), self.index.num_docs))
+            matched = np.zeros((len(batch), self.index.num_docs), dtype=bool)
+            for token, column in columns.items():
+                doc_ids, term_scores = self.term_scores(token)
+                rows = np.fromiter(column.keys(), dtype=np.intp)
+                weights = np.fromiter(column.values(), dtype=np.float64)
+                block = np.ix_(rows, doc_ids)
+                scores[block] += weights[:, None] * term_scores
+                matched[block] = True
+            for row in range(len(batch)):
+                doc_ids = top_documents(scores[row],
+                                        np.flatnonzero(matched[row]), k)
+                rankings.append((doc_ids, scores[row][doc_ids]))
+        return rankings
+
+    def term_bounds(self, token):
+        '''Return the (upper, lower) bound of the unweighted term score'''
+        if self.use_impacts:
+            return self.index.impact_bounds(token)
+        max_tf, min_tf, min_len, max_len = self.index.stats(token)
+        mu = self.mu
+        bglm = self.index.bglm(token)
+        return (np.log2((mu + max_tf / bglm) / (mu + min_len)),
+                np.log2((mu + min_tf / bglm) / (mu + max_len)))
+
+    def top_k(self, terms, k, feedback_terms=(), feedback_weight=1.0):
+        '''
+        MaxScore-style top-k retrieval.
+
+        Terms are processed in decreasing order of their score upper bound.
+        Once the documents seen so far make the k-th best score unreachable
+        for unseen documents, the remaining posting lists are only probed at
+        the surviving candidates with a binary search, instead of being
+        scored in full. Contributions can be negative, so the k-th score is
+        bounded from below with the lower bounds of the remaining terms.
+
+        Args:
+          terms: list of (token, weight), e.g. from query_terms
+          k: number of documents to return
+          feedback_terms(default=()): terms whose scores are added on top
+            of the query scores, as RetrievalSystem feedback does
+          feedback_weight(default=1.0): weight of the feedback scores
+        Returns:
+          doc_ids: the top-k doc IDs, sorted as rank_documents does
+          scores: their scores, identical to the full scoring path
+        '''
+        # contributions are linear in the weight, so merge repeated tokens
+        weights = {}
+        for token, weight in terms:
+            weights[token] = weights.get(token, 0.0) + weight
+        for token, weight in feedback_terms:
+            weights[token] = weights.get(token, 0.0) + \
+                             feedback_weight * weight
+        tokens = list(weights)
+        upper = np.zeros(len(tokens))
+        lower = np.zeros(len(tokens))
+        for ind, token in enumerate(tokens):
+            bounds = weights[token] * np.array(self.term_bounds(token))
+            upper[ind], lower[ind] = bounds.max(), bounds.min()
+        order = np.argsort(-upper, kind='stable')
+        tokens = [tokens[ind] for ind in order]
+        # bounds of everything that is still to be added after each term
+        rest_upper = np.append(np.cumsum(np.maximum(upper[order], 0)[::-1])
+                               [::-1], 0)[1:]
+        rest_lower = np.append(np.cumsum(np.minimum(lower[order], 0)[::-1])
+                               [::-1], 0)[1:]
+
+        scores = np.zeros(self.index.num_docs)
+        matched = np.zeros(self.index.num_docs, dtype=bool)
+        candidates = None
+        for ind, token in enumerate(tokens):
+            if candidates is None:
+                doc_ids, term_scores = self.term_scores(token)
+                scores[doc_ids] += weights[token] * term_scores
+                matched[doc_ids] = True
+                if ind + 1 < len(tokens):
+                    candidates = self.__prune(np.flatnonzero(matched), scores,
+                            k, rest_upper[ind], rest_lower[ind], True)
+            else:
+                doc_ids, term_scores = self.__probe(token, candidates)
+                scores[doc_ids] += weights[token] * term_scores
+                candidates = self.__prune(candidates, scores, k,
+                        rest_upper[ind], rest_lower[ind], False)
+        if candidates is None:
+            candidates = np.flatnonzero(matched)
+        # rescore the survivors in the original term order, so the scores
+        # are bit-for-bit the ones the full scoring path computes
+        final_scores = self.__rescore(terms, candidates)
+        if feedback_terms:
+            final_scores += feedback_weight * \
+                            self.__rescore(feedback_terms, candidates)
+        candidate_mask = np.zeros(self.index.num_docs, dtype=bool)
+        candidate_mask[candidates] = True
+        doc_ids = rank_documents(final_scores, candidate_mask)[:k]
+        return doc_ids, final_scores[doc_ids]
+
+    def __prune(self, doc_ids, scores, k, rest_upper, rest_lower, exhaustive):
+        '''
+        Return the documents in "doc_ids" that can still reach the top k, or
+        None if unseen documents still can (only checked when "exhaustive").
+        '''
+        if len(doc_ids) < k:
+            return None if exhaustive else doc_ids
+        # the k-th best final score is at least this
+        theta = -np.partition(-(scores[doc_ids] + rest_lower), k - 1)[k - 1]
+        # leave room for rounding, since terms are added in another order
+        theta -= 1e-9 * (abs(theta) + 1)
+        if exhaustive and rest_upper >= theta:
+            return None
+        return doc_ids[scores[doc_ids] + rest_upper >= theta]
+
+    def __rescore(self, terms, doc_ids):
+        '''Dense scores of "terms" computed only at sorted "doc_ids"'''
+        scores = np.zeros(self.index.num_docs)
+        for token, weight in terms:
+            hit_ids, term_scores = self.__probe(token, doc_ids)
+            scores[hit_ids] += weight * term_scores
+        return scores
+
+    def __probe(self, token, doc_ids):
+        '''Return (doc_ids, scores) of "token" at the sorted "doc_ids"'''
+        if self.use_impacts:
+            return self.index.impacts_at(token, doc_ids)
+        doc_ids, tfs = self.index.postings_at(token, doc_ids)
+        mu = self.mu
+        scores = np.log2((mu + tfs / self.index.bglm(token)) / \
+                         (mu + self.index.doclen[doc_ids]))
+        return doc_ids, scores
+
+def rank_documents(scores, matched):
+    '''
+    Return the matched doc IDs sorted by descending score. Ties keep the
+    doc ID order.
+    '''
+    doc_ids = np.flatnonzero(matched)
+    return doc_ids[np.argsort(-scores[doc_ids], kind='stable')]
+
+def top_documents(scores, doc_ids, k=None):
+    '''
+    Return the k best of the sorted "doc_ids", ordered as rank_documents
+    does, without sorting the whole list.
+    '''
+    if k is not None and len(doc_ids) > k:
+        kth = -np.partition(-scores[doc_ids], k - 1)[k - 1]
+        doc_ids = doc_ids[scores[doc_ids] >= kth]
+    return doc_ids[np.argsort(-scores[doc_ids], kind='stable')][:k]
+
+def merge_rankings(doc_ids1, scores1, doc_ids2, scores2):
+    '''
+    Merge two rankings that are both sorted as rank_documents does, in
+    linear time instead of sorting them again.
+
+    Returns:
+      doc_ids: merged doc IDs
+      scores: their scores
+    '''
+    pos = np.searchsorted(-scores1, -scores2, side='left')
+    tie_end = np.searchsorted(-scores1, -scores2, side='right')
+    # equal scores are ordered by doc ID
+    for ind in np.flatnonzero(tie_end > pos):
+        pos[ind] += np.searchsorted(doc_ids1[pos[ind]:tie_end[ind]],
+                                    doc_ids2[ind])
+    return (np.insert(doc_ids1, pos, doc_ids2),
+            np.insert(scores1, pos, scores2))
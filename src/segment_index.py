@@ -0,0 +1,612 @@
+# File name: segment_index.py
+# python version: 3.5+
+# Description:
+#   Segment-based inverted index that takes new and deleted documents as
+#   small delta segments, so the corpus can change without a full rebuild.
+'''Segmented inverted index
+
+A segmented index is a directory of binary index segments (see
+binary_index.py) listed by "manifest.json":
+
+  {"format": "iir-segments", "version": 1,
+   "generation": number of changes so far,
+   "next_segment": number of the next segment file,
+   "segments": [{"file": segment file name,
+                 "num_docs": number of documents in the segment,
+                 "deleted": sorted names of its deleted documents,
+                 "docs": document store of its documents,
+                 "keywords": keyword store of its documents}]}
+
+"docs" and "keywords" are optional. The document store (see doc_store.py)
+is written along with the segment, and the keyword store (see
+keyword_store.py) when the keyterm files of the added documents are given,
+so a retrieval system picks up the text and keyterms of new documents
+without reading the whole corpus again.
+
+Adding documents writes one new segment. Deleting a document only records
+a tombstone, and adding a document again also tombstones its older copy,
+so a file name is live in at most one segment. merge_segments rewrites
+some segments as one and drops their deleted documents, and can run in a
+background thread while readers keep using the files they have mapped.
+
+The bglm stored in a segment only covers that segment. SegmentedIndex
+gathers the live postings of all segments on demand and derives doclen and
+bglm from the live documents alone, so it scores exactly like an index
+rebuilt from the current corpus. For the bichar total of the live
+documents, each segment also holds the array
+
+  doc_bichars  float64 (D,)  number of bichars in each document
+
+Segments written without it are counted from their postings.
+'''
+import os
+import json
+import fcntl
+import tempfile
+import threading
+import numpy as np
+from contextlib import contextmanager
+from util import load_arrays
+from util import save_arrays
+from binary_index import BinaryIndex
+from binary_index import INDEX_FORMAT
+from binary_index import INDEX_VERSION
+from binary_index import find_postings
+from binary_index import posting_arrays
+from binary_index import dict_arrays
+from build_corpus import background_lm
+from build_corpus import scan_files
+from doc_store import DocStore
+from doc_store import pack_doc_store
+from doc_store import save_doc_store
+from keyword_store import KeywordStore
+from keyword_store import pack_keyword_store
+from keyword_store import read_keyterm_files
+from keyword_store import save_keyword_store
+
+SEGMENTS_FORMAT = 'iir-segments'
+SEGMENTS_VERSION = 1
+MANIFEST = 'manifest.json'
+# file name suffixes of the stores of a segment, by manifest entry key
+STORE_SUFFIXES = {'docs': '.docs', 'keywords': '.keys'}
+# held while the manifest is read or replaced
+MANIFEST_LOCK = 'manifest.lock'
+# held by the only merge that may run at a time
+MERGE_LOCK = 'merge.lock'
+
+def is_segmented_index(path):
+    '''Whether "path" is a segmented index directory'''
+    return os.path.isfile(os.path.join(path, MANIFEST))
+
+@contextmanager
+def locked(index_dir, lock_name=MANIFEST_LOCK, shared=False):
+    '''Hold a lock file of "index_dir" across processes'''
+    with open(os.path.join(index_dir, lock_name), 'a') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+def read_manifest(index_dir):
+    '''Return the manifest of "index_dir", or an empty one'''
+    filename = os.path.join(index_dir, MANIFEST)
+    if not os.path.isfile(filename):
+        return {'format': SEGMENTS_FORMAT, 'version': SEGMENTS_VERSION,
+                'generation': 0, 'next_segment': 0, 'segments': []}
+    with open(filename) as f:
+        manifest = json.load(f)
+    if manifest.get('format') != SEGMENTS_FORMAT or \
+            manifest.get('version') != SEGMENTS_VERSION:
+        raise ValueError('{0} is not a version {1} segmented index'.format(
+                         index_dir, SEGMENTS_VERSION))
+    return manifest
+
+def write_manifest(index_dir, manifest):
+    '''Replace the manifest of "index_dir" atomically'''
+    filename = os.path.join(index_dir, MANIFEST)
+    with open(filename + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(filename + '.tmp', filename)
+
+class SegmentedIndex:
+    '''
+    Index view over the live documents of a segmented index, as DictIndex.
+
+    Doc IDs are the positions of the sorted live file names. Posting lists
+    are gathered from the segments whenever they are asked for and are not
+    kept, so the index holds no more than the mapped segments; callers
+    cache what they derive from them (see scoring.TermCache). Only the
+    stats and live tf total of each token are kept, in one dict entry per
+    token, which is safe to fill from several threads.
+
+    The document and keyword stores of the segments are opened along with
+    them, None for segments without one.
+    '''
+    # impacts depend on the bglm of the whole index, so segments have none
+    impact_mu = None
+
+    def __init__(self, index_dir, segments=None):
+        '''
+        Args:
+          index_dir: segmented index directory
+          segments(default=None): manifest entries of the segments to open,
+            all the segments of the current manifest if not given
+        '''
+        self.index_dir = index_dir
+        if segments is None:
+            # a merge never removes segment files while this is held
+            with locked(index_dir, shared=True):
+                manifest = read_manifest(index_dir)
+                self.generation = manifest['generation']
+                segments = manifest['segments']
+                self.__open(segments)
+        else:
+            self.generation = None
+            self.__open(segments)
+        names = []
+        doclens = []
+        lives = []
+        self.bichar_total = 0
+        for seg, entry in zip(self.segments, segments):
+            seg_names = seg.arrays['doc_names']
+            live = ~np.isin(seg_names, np.array(entry['deleted'],
+                                                dtype=np.str_))
+            names.append(seg_names[live])
+            doclens.append(seg.doclen[live])
+            lives.append(live)
+            self.bichar_total += int(doc_bichars(seg)[live].sum())
+        # segment of each live document, before sorting by name
+        seg_of = np.repeat(np.arange(len(lives)), [np.count_nonzero(live)
+                                                   for live in lives])
+        doc_names = np.concatenate(names) if names else \
+            np.zeros(0, dtype=np.str_)
+        order = np.argsort(doc_names, kind='stable')
+        self.doc_name_array = doc_names[order]
+        self.doc_names = self.doc_name_array.tolist()
+        self.doclen = np.concatenate(doclens)[order] if doclens else \
+            np.zeros(0)
+        self.doc_segments = seg_of[order]
+        self.num_docs = len(self.doc_names)
+        # doclen counts the chars of a document
+        self.char_total = int(self.doclen.sum())
+        # segment doc ID -> doc ID, -1 for deleted documents
+        rank = np.zeros(self.num_docs, dtype=np.int32)
+        rank[order] = np.arange(self.num_docs)
+        self.id_maps = []
+        start = 0
+        for live in lives:
+            id_map = np.full(len(live), -1, dtype=np.int32)
+            id_map[live] = rank[start:start + np.count_nonzero(live)]
+            start += np.count_nonzero(live)
+            self.id_maps.append(id_map)
+        # whether each term of a segment occurs in a live document, None
+        # until it is needed; all of them do in a segment without deletions
+        self.live_terms = [None if entry['deleted'] else True
+                           for entry in segments]
+        # token -> (stats, live tf total), stats None without postings
+        self.token_entries = {}
+
+    def __open(self, segments):
+        '''Open the segments listed in "segments" and their stores'''
+        def path(name):
+            return os.path.join(self.index_dir, name)
+        self.files = [entry['file'] for entry in segments]
+        self.segments = [BinaryIndex(path(entry['file']))
+                         for entry in segments]
+        self.doc_stores = [DocStore.load(path(entry['docs']))
+                           if 'docs' in entry else None
+                           for entry in segments]
+        self.keyword_stores = [KeywordStore.load(path(entry['keywords']))
+                               if 'keywords' in entry else None
+                               for entry in segments]
+
+    def __contains__(self, token):
+        '''Whether "token" occurs in a live document'''
+        for pos, seg in enumerate(self.segments):
+            if token in seg:
+                live_terms = self.__live_terms(pos)
+                if live_terms is True or live_terms[seg.term_id(token)]:
+                    return True
+        return False
+
+    def __live_terms(self, pos):
+        '''Return the live term mask of segment "pos", see __init__'''
+        live_terms = self.live_terms[pos]
+        if live_terms is None:
+            seg = self.segments[pos]
+            doc_ids, _ = seg.all_postings()
+            terms = np.repeat(np.arange(len(seg.vocab)), np.diff(seg.offsets))
+            live_terms = np.bincount(terms[self.id_maps[pos][doc_ids] >= 0],
+                                     minlength=len(seg.vocab)) > 0
+            self.live_terms[pos] = live_terms
+        return live_terms
+
+    def postings(self, token):
+        '''Return (doc_ids, tfs) of "token", sorted by doc ID'''
+        ids = []
+        tfs = []
+        for seg, id_map in zip(self.segments, self.id_maps):
+            if token in seg:
+                seg_ids, seg_tfs = seg.postings(token)
+                seg_ids = id_map[seg_ids]
+                live = seg_ids >= 0
+                ids.append(seg_ids[live])
+                tfs.append(seg_tfs[live])
+        doc_ids = np.concatenate(ids) if ids else np.zeros(0, dtype=np.int32)
+        tfs = np.concatenate(tfs) if tfs else np.zeros(0, dtype=np.int32)
+        order = np.argsort(doc_ids, kind='stable')
+        return doc_ids[order], tfs[order]
+
+    def __entry(self, token):
+        '''Return (stats, live tf total) of "token", computing it once'''
+        entry = self.token_entries.get(token)
+        if entry is None:
+            doc_ids, tfs = self.postings(token)
+            stats = None
+            if len(doc_ids):
+                doclen = self.doclen[doc_ids]
+                stats = (tfs.max(), tfs.min(), doclen.min(), doclen.max())
+            entry = (stats, int(tfs.sum()))
+            self.token_entries[token] = entry
+        return entry
+
+    def postings_at(self, token, doc_ids):
+        '''Return (doc_ids, tfs) of "token" at the sorted "doc_ids"'''
+        return find_postings(*self.postings(token), doc_ids=doc_ids)
+
+    def stats(self, token):
+        '''Return (max_tf, min_tf, min_doclen, max_doclen) of "token"'''
+        return self.__entry(token)[0]
+
+    def bglm(self, token):
+        '''Background probability of "token" among the live documents'''
+        total = self.char_total if len(token) == 1 else self.bichar_total
+        return self.__entry(token)[1] / total
+
+    def doc_id(self, doc):
+        '''Return the doc ID of file name "doc"'''
+        return int(np.searchsorted(self.doc_name_array, doc))
+
+    def segment_of(self, doc):
+        '''Return the segment position of live document "doc", or -1'''
+        pos = self.doc_id(doc)
+        if pos < self.num_docs and self.doc_names[pos] == doc:
+            return int(self.doc_segments[pos])
+        return -1
+
+    def segment_docs(self, pos):
+        '''Return the names of the live documents of segment "pos"'''
+        return self.doc_name_array[self.doc_segments == pos].tolist()
+
+class SegmentDocStore:
+    '''
+    Documents of a SegmentedIndex, with the methods of DocStore. A live
+    document is read from the document store of its segment if that holds
+    it, and any other document from the first of "stores" that holds it.
+    '''
+    def __init__(self, index, stores):
+        self.index = index
+        self.stores = stores
+
+    def __contains__(self, doc):
+        return self.store_of(doc) is not None
+
+    def store_of(self, doc):
+        '''Return the store that "doc" is read from, or None'''
+        pos = self.index.segment_of(doc)
+        if pos >= 0:
+            store = self.index.doc_stores[pos]
+            if store is not None and doc in store:
+                return store
+        for store in self.stores:
+            if doc in store:
+                return store
+        return None
+
+    def __store(self, doc):
+        store = self.store_of(doc)
+        if store is None:
+            raise KeyError(doc)
+        return store
+
+    def doc_words(self, doc):
+        '''Return the words of "doc" in reading order'''
+        return self.__store(doc).doc_words(doc)
+
+    def text(self, doc):
+        '''Return the whole text of "doc" without spaces'''
+        return self.__store(doc).text(doc)
+
+    def vocabulary(self, doc):
+        '''Return the set of words in "doc"'''
+        return self.__store(doc).vocabulary(doc)
+
+    def doc_frequencies(self, docs, words):
+        '''Return how many of "docs" contain each of "words"'''
+        groups = {}
+        for doc in docs:
+            store = self.__store(doc)
+            groups.setdefault(id(store), (store, []))[1].append(doc)
+        counts = np.zeros(len(words), dtype=np.int64)
+        for store, group in groups.values():
+            counts += store.doc_frequencies(group, words)
+        return counts
+
+class SegmentKeywords:
+    '''
+    Keywords of a SegmentedIndex, read like the {filename: [(keyword,
+    score)]} dict of util.read_keyword_dir. The keywords of a live
+    document come from the keyword store of its segment if that holds it,
+    and those of any other document from the first of "stores" that holds
+    it. Keywords up to line "thres" of each keyterm file are kept, as
+    keyword_store.load_keywords does.
+    '''
+    def __init__(self, index, stores, thres=10000):
+        self.index = index
+        self.stores = stores
+        self.top_n = thres + 1
+
+    def __contains__(self, doc):
+        try:
+            self[doc]
+        except KeyError:
+            return False
+        return True
+
+    def __getitem__(self, doc):
+        pos = self.index.segment_of(doc)
+        if pos >= 0:
+            store = self.index.keyword_stores[pos]
+            if store is not None and doc in store:
+                return store.keywords(doc, self.top_n)
+        for store in self.stores:
+            if doc in store:
+                return store[doc]
+        raise KeyError(doc)
+
+def doc_bichars(seg):
+    '''Return the number of bichars in each document of segment "seg"'''
+    if 'doc_bichars' in seg.arrays:
+        return seg.arrays['doc_bichars']
+    doc_ids, tfs = seg.all_postings()
+    return bichar_counts(seg.vocab, seg.offsets, doc_ids, tfs, seg.num_docs)
+
+def bichar_counts(vocab, offsets, doc_ids, tfs, num_docs):
+    '''Return the number of bichars in each document of the postings'''
+    is_bichar = np.repeat(np.char.str_len(vocab) == 2, np.diff(offsets))
+    return np.bincount(doc_ids[is_bichar], weights=tfs[is_bichar],
+                       minlength=num_docs)
+
+def segment_arrays(arrays):
+    '''Add the doc_bichars array to the posting_arrays of a segment'''
+    arrays['doc_bichars'] = bichar_counts(
+        arrays['vocab'], arrays['offsets'], arrays['doc_ids'],
+        arrays['tfs'], len(arrays['doc_names']))
+    return arrays
+
+def merged_arrays(index):
+    '''Return the binary index arrays of the live postings of "index"'''
+    if not index.segments:
+        vocab = np.zeros(0, dtype=np.str_)
+    else:
+        vocab = np.unique(np.concatenate([seg.vocab
+                                          for seg in index.segments]))
+    terms = [np.zeros(0, dtype=np.int64)]
+    doc_ids = [np.zeros(0, dtype=np.int32)]
+    tfs = [np.zeros(0, dtype=np.int32)]
+    for seg, id_map in zip(index.segments, index.id_maps):
+        seg_terms = np.repeat(np.searchsorted(vocab, seg.vocab),
+                              np.diff(seg.offsets))
+        seg_ids, seg_tfs = seg.all_postings()
+        seg_ids = id_map[seg_ids]
+        live = seg_ids >= 0
+        terms.append(seg_terms[live])
+        doc_ids.append(seg_ids[live])
+        tfs.append(seg_tfs[live])
+    terms = np.concatenate(terms)
+    doc_ids = np.concatenate(doc_ids)
+    tfs = np.concatenate(tfs)
+    order = np.lexsort((doc_ids, terms))
+    counts = np.bincount(terms, minlength=len(vocab))
+    totals = np.bincount(terms, weights=tfs, minlength=len(vocab))
+    # drop the terms of deleted documents only
+    kept = counts > 0
+    vocab, counts, totals = vocab[kept], counts[kept], totals[kept]
+    offsets = np.zeros(len(vocab) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(counts)
+    bglm = totals / np.where(np.char.str_len(vocab) == 1,
+                             index.char_total, max(index.bichar_total, 1))
+    return segment_arrays(posting_arrays(vocab, offsets, doc_ids[order],
+                                         tfs[order], bglm, index.doc_names,
+                                         index.doclen))
+
+def merged_stores(index_dir, index):
+    '''
+    Write the document and keyword stores of the live documents of "index"
+    that its segments hold, and return their temporary files as
+    add_segment takes them.
+    '''
+    words_dict = {}
+    keywords_dict = {}
+    dtype = None
+    for pos, (doc_store, keyword_store) in enumerate(zip(
+            index.doc_stores, index.keyword_stores)):
+        docs = index.segment_docs(pos) if doc_store is not None or \
+            keyword_store is not None else []
+        if doc_store is not None:
+            words_dict.update((doc, doc_store.doc_words(doc)) for doc in docs)
+        if keyword_store is not None:
+            dtype = keyword_store.scores.dtype
+            for doc in docs:
+                if doc in keyword_store:
+                    keyword_ids, scores = keyword_store.keyword_arrays(doc)
+                    keywords_dict[doc] = (keyword_store.words.take(
+                        keyword_ids), scores)
+    store_files = {}
+    if words_dict:
+        store_files['docs'] = new_segment_file(index_dir)
+        save_doc_store(store_files['docs'], pack_doc_store(words_dict))
+    if keywords_dict:
+        store_files['keywords'] = new_segment_file(index_dir)
+        save_keyword_store(store_files['keywords'],
+                           pack_keyword_store(keywords_dict, dtype))
+    return store_files
+
+def mark_deleted(index_dir, manifest, doc_names):
+    '''Tombstone the live copies of "doc_names" in "manifest"
+
+    Returns:
+      count: number of documents that were deleted
+    '''
+    doc_names = np.array(sorted(doc_names), dtype=np.str_)
+    count = 0
+    for seg in manifest['segments']:
+        arrays, _ = load_arrays(os.path.join(index_dir, seg['file']))
+        names = arrays['doc_names']
+        found = set(names[np.isin(names, doc_names)].tolist())
+        found.difference_update(seg['deleted'])
+        if found:
+            seg['deleted'] = sorted(found.union(seg['deleted']))
+            count += len(found)
+    return count
+
+def new_segment_file(index_dir):
+    '''Return a temporary file name to write a segment to'''
+    fd, filename = tempfile.mkstemp(suffix='.tmp', dir=index_dir)
+    os.close(fd)
+    return filename
+
+def add_segment(index_dir, manifest, tmp_file, entry, store_files=None):
+    '''
+    Move "tmp_file" to the next segment file name, and the temporary store
+    files of "store_files", e.g. {"docs": file}, next to it.
+    Return the manifest entry "entry" with their names.
+    '''
+    name = 'segment-{0:06d}'.format(manifest['next_segment'])
+    manifest['next_segment'] += 1
+    for key, store_file in sorted((store_files or {}).items()):
+        entry[key] = name + STORE_SUFFIXES[key]
+        os.replace(store_file, os.path.join(index_dir, entry[key]))
+    entry['file'] = name + '.bin'
+    os.replace(tmp_file, os.path.join(index_dir, entry['file']))
+    return entry
+
+def add_documents(index_dir, files, keyword_dir=None):
+    '''
+    Index a list of (filename, filepath) as a new segment of "index_dir".
+    Documents that are already indexed are replaced.
+
+    Args:
+      index_dir: segmented index directory
+      files: list of (filename, filepath) of the documents
+      keyword_dir(default=None): keyterm directory that holds the keyterm
+        files of the documents, stored with the segment
+    '''
+    os.makedirs(index_dir, exist_ok=True)
+    index_dict, len_dict, words_dict = scan_files(files)
+    if not len_dict:
+        return
+    tmp_file = new_segment_file(index_dir)
+    save_arrays(tmp_file, segment_arrays(dict_arrays(
+                index_dict, len_dict, background_lm(index_dict))),
+                {'format': INDEX_FORMAT, 'version': INDEX_VERSION})
+    store_files = {'docs': new_segment_file(index_dir)}
+    save_doc_store(store_files['docs'], pack_doc_store(words_dict))
+    if keyword_dir is not None:
+        keyword_files = [(doc, os.path.join(keyword_dir, doc))
+                         for doc in sorted(len_dict)]
+        keyword_files = [(doc, path) for doc, path in keyword_files
+                         if os.path.isfile(path)]
+        if keyword_files:
+            store_files['keywords'] = new_segment_file(index_dir)
+            save_keyword_store(store_files['keywords'], pack_keyword_store(
+                read_keyterm_files(keyword_files)))
+    with locked(index_dir):
+        manifest = read_manifest(index_dir)
+        mark_deleted(index_dir, manifest, len_dict)
+        manifest['segments'].append(add_segment(index_dir, manifest,
+                tmp_file, {'num_docs': len(len_dict), 'deleted': []},
+                store_files))
+        manifest['generation'] += 1
+        write_manifest(index_dir, manifest)
+
+def delete_documents(index_dir, doc_names):
+    '''
+    Delete the documents named "doc_names" from "index_dir"
+
+    Returns:
+      count: number of documents that were deleted
+    '''
+    with locked(index_dir):
+        manifest = read_manifest(index_dir)
+        count = mark_deleted(index_dir, manifest, doc_names)
+        if count:
+            manifest['generation'] += 1
+            write_manifest(index_dir, manifest)
+    return count
+
+def merge_segments(index_dir, max_segments=1, purge=False):
+    '''
+    Merge the smallest segments of "index_dir" until at most
+    "max_segments" are left, dropping the deleted documents they hold.
+
+    Args:
+      index_dir: segmented index directory
+      max_segments(default=1): number of segments to keep
+      purge(default=False): also rewrite segments with deleted documents
+    Returns:
+      merged: whether any segment was rewritten
+    '''
+    with locked(index_dir, MERGE_LOCK):
+        with locked(index_dir):
+            segments = read_manifest(index_dir)['segments']
+        def live_docs(seg):
+            return seg['num_docs'] - len(seg['deleted'])
+        if len(segments) > max_segments:
+            chosen = sorted(segments, key=live_docs)[:len(segments) -
+                                                     max_segments + 1]
+        elif purge:
+            chosen = [seg for seg in segments if seg['deleted']]
+        else:
+            chosen = []
+        if not chosen:
+            return False
+        merged = SegmentedIndex(index_dir, chosen)
+        tmp_file = new_segment_file(index_dir)
+        save_arrays(tmp_file, merged_arrays(merged),
+                    {'format': INDEX_FORMAT, 'version': INDEX_VERSION})
+        store_files = merged_stores(index_dir, merged)
+        files = {seg['file']: seg['deleted'] for seg in chosen}
+        with locked(index_dir):
+            manifest = read_manifest(index_dir)
+            # documents deleted or replaced while we were merging
+            deleted = set()
+            for seg in manifest['segments']:
+                if seg['file'] in files:
+                    deleted.update(set(seg['deleted']) -
+                                   set(files[seg['file']]))
+            deleted = np.array(sorted(deleted), dtype=np.str_)
+            deleted = deleted[np.isin(deleted, merged.doc_name_array)]
+            pos = min(ind for ind, seg in enumerate(manifest['segments'])
+                      if seg['file'] in files)
+            manifest['segments'] = [seg for seg in manifest['segments']
+                                    if seg['file'] not in files]
+            manifest['segments'].insert(pos, add_segment(index_dir, manifest,
+                    tmp_file, {'num_docs': merged.num_docs,
+                               'deleted': deleted.tolist()}, store_files))
+            manifest['generation'] += 1
+            write_manifest(index_dir, manifest)
+            # open readers keep the pages they have mapped
+            for seg in chosen:
+                for key in ('file',) + tuple(STORE_SUFFIXES):
+                    if key in seg:
+                        os.remove(os.path.join(index_dir, seg[key]))
+    return True
+
+def merge_in_background(index_dir, max_segments=1):
+    '''Start merge_segments in a daemon thread and return the thread'''
+    thread = threading.Thread(target=merge_segments,
+                              args=(index_dir, max_segments), daemon=True)
+    thread.start()
+    return thread
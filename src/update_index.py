@@ -0,0 +1,57 @@
+# File name: update_index.py
+# python version: 3.5+
+# Description:
+#   Add, delete and merge documents of a segmented index.
+"""update_index.py
+
+Usage:
+    update_index.py add [options] <index_dir> <doc>...
+    update_index.py delete [options] <index_dir> <doc_name>...
+    update_index.py merge [options] <index_dir>
+    update_index.py -h
+
+Options:
+    -h --help               : show help message
+    --max-segments=<n>      : merge down to this many segments [default: 1]
+    --purge                 : also rewrite segments with deleted documents
+    --merge                 : merge after adding or deleting
+    --keyterms=<dir>        : keyterm directory of the added documents
+
+"add" indexes document files, or every file of document directories, as
+one new segment, replacing documents with the same file name. The segment
+also stores the added documents, and their keyterm files if a keyterm
+directory is given. "delete" takes file names. RetrievalSystem.refresh()
+picks the changes up; it reads the keyterms of documents added without
+them from its keyterm directory.
+"""
+import os
+from docopt import docopt
+from util import walk_all_files
+from segment_index import add_documents
+from segment_index import delete_documents
+from segment_index import merge_segments
+
+def doc_files(paths):
+    '''Return (filename, filepath) of the files and directories "paths"'''
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(walk_all_files(path))
+        else:
+            files.append((os.path.basename(path), path))
+    return files
+
+def main(docopt_args):
+    index_dir = docopt_args['<index_dir>']
+    if docopt_args['add']:
+        add_documents(index_dir, doc_files(docopt_args['<doc>']),
+                      docopt_args['--keyterms'])
+    elif docopt_args['delete']:
+        count = delete_documents(index_dir, docopt_args['<doc_name>'])
+        print('{0} documents deleted'.format(count))
+    if docopt_args['merge'] or docopt_args['--merge']:
+        merge_segments(index_dir, int(docopt_args['--max-segments']),
+                       docopt_args['--purge'])
+
+if __name__ == '__main__':
+    main(docopt(__doc__))
@@ -56,6 +56,9 @@ class User:
             if d in self.ans_dict[query]:
                 num_ret += 1
                 AP += num_ret / (i+1) / len(self.ans_dict[query])
+                # the rest of a lazy ranking list need not be sorted
+                if num_ret == len(self.ans_dict[query]):
+                    break
         return AP
     def next_query(self):
         self.curr_query_index += 1
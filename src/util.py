@@ -6,9 +6,14 @@
 # Description:
 #   Utility function for convience.
 import os
+import json
+import mmap
 import pickle
+import struct
+import threading
 import numpy as np
 import numpy.random as npr
+from collections import OrderedDict
 
 def walk_all_files(dirname):
     '''Return an generator for all files in the "dirname"'''
@@ -51,10 +56,222 @@ def pickle_load(filename):
     with open(filename, 'rb') as f:
         return pickle.load(f)
 
+class ByteLRUCache:
+    '''
+    LRU cache of tuples of arrays, bounded by their size in bytes.
+
+    "hits" and "misses" count the lookups, which helps to size the cache.
+    It is safe to share between threads.
+    '''
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        '''Return the cached value of "key", or None'''
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        '''Store a tuple of arrays, evicting the least recently used ones'''
+        size = sum(array.nbytes for array in value)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.nbytes -= sum(array.nbytes
+                                   for array in self.entries[key])
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.nbytes -= sum(array.nbytes for array in evicted)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self):
+        '''Return (hits, misses, entries, bytes)'''
+        return (self.hits, self.misses, len(self.entries), self.nbytes)
+
+# Array bundle: several NumPy arrays in one file that can be memory-mapped.
+#   bytes 0-7   : BUNDLE_MAGIC
+#   bytes 8-15  : little-endian uint64, length of the JSON header
+#   JSON header : {"attrs": {...}, "arrays": {name: {"dtype", "shape",
+#                 "offset"}}}, offsets are counted from the start of file
+#   array data  : raw C-order data of each array, aligned to BUNDLE_ALIGN
+BUNDLE_MAGIC = b'IIRARRAY'
+BUNDLE_ALIGN = 64
+
+def is_array_bundle(filename):
+    '''Whether "filename" is an array bundle'''
+    if not os.path.isfile(filename):
+        return False
+    with open(filename, 'rb') as f:
+        return f.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC
+
+def create_arrays(filename, specs, attrs=None):
+    '''Create an array bundle and return its arrays for writing
+
+    Args:
+      filename: output file name
+      specs: list of (name, dtype, shape)
+      attrs(default=None): JSON-serializable dict stored with the arrays
+    Returns:
+      arrays: dict of writable arrays mapped onto the file
+    '''
+    def align(offset):
+        return (offset + BUNDLE_ALIGN - 1) // BUNDLE_ALIGN * BUNDLE_ALIGN
+    entries = {}
+    header = b''
+    # the offsets depend on the header length, which depends on the offsets
+    while True:
+        offset = align(16 + len(header))
+        for name, dtype, shape in specs:
+            dtype = np.dtype(dtype)
+            shape = tuple(int(x) for x in np.atleast_1d(shape))
+            entries[name] = {'dtype': dtype.str, 'shape': shape,
+                             'offset': offset}
+            offset = align(offset + dtype.itemsize * int(np.prod(shape)))
+        new_header = json.dumps({'attrs': attrs or {},
+                                 'arrays': entries}).encode('utf-8')
+        done = len(new_header) == len(header)
+        header = new_header
+        if done:
+            break
+    with open(filename, 'wb') as f:
+        f.write(BUNDLE_MAGIC)
+        f.write(struct.pack('<Q', len(header)))
+        f.write(header)
+        f.truncate(offset)
+    arrays = {}
+    for name, entry in entries.items():
+        if np.prod(entry['shape']) == 0:
+            arrays[name] = np.zeros(entry['shape'], dtype=entry['dtype'])
+        else:
+            arrays[name] = np.memmap(filename, dtype=entry['dtype'],
+                                     mode='r+', offset=entry['offset'],
+                                     shape=entry['shape'])
+    return arrays
+
+def save_arrays(filename, arrays, attrs=None):
+    '''Write a dict of arrays as an array bundle'''
+    arrays = {name: np.ascontiguousarray(array)
+              for name, array in arrays.items()}
+    out = create_arrays(filename, [(name, array.dtype, array.shape)
+                                   for name, array in arrays.items()], attrs)
+    for name, array in arrays.items():
+        out[name][...] = array
+        if isinstance(out[name], np.memmap):
+            out[name].flush()
+
+def load_arrays(filename):
+    '''Memory-map an array bundle
+
+    Returns:
+      arrays: dict of read-only arrays backed by the page cache
+      attrs: the attributes stored with the arrays
+    '''
+    with open(filename, 'rb') as f:
+        if f.read(len(BUNDLE_MAGIC)) != BUNDLE_MAGIC:
+            raise ValueError('{0} is not an array bundle'.format(filename))
+        header_len, = struct.unpack('<Q', f.read(8))
+        header = json.loads(f.read(header_len).decode('utf-8'))
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    arrays = {}
+    for name, entry in header['arrays'].items():
+        dtype = np.dtype(entry['dtype'])
+        shape = tuple(entry['shape'])
+        count = int(np.prod(shape))
+        if count == 0:
+            arrays[name] = np.zeros(shape, dtype=dtype)
+        else:
+            arrays[name] = np.frombuffer(buf, dtype=dtype, count=count,
+                                         offset=entry['offset']).reshape(shape)
+    return arrays, header['attrs']
+
+class StringArray:
+    '''
+    Sorted strings kept as UTF-8 bytes and an offsets table, so a long
+    string takes only its own bytes instead of widening every entry of a
+    fixed-width <U array. UTF-8 bytes sort in code point order, which is
+    the order of sorted str.
+
+    The string to position dict that search() uses is built on its first
+    call.
+    '''
+    def __init__(self, data, offsets):
+        self.data = data
+        self.offsets = offsets
+        self.positions = None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, pos):
+        return bytes(self.data[self.offsets[pos]:
+                               self.offsets[pos + 1]]).decode('utf-8')
+
+    def take(self, positions):
+        '''Return the list of strings at "positions"'''
+        data = self.data
+        offsets = self.offsets
+        return [bytes(data[offsets[pos]:offsets[pos + 1]]).decode('utf-8')
+                for pos in np.asarray(positions, dtype=np.int64).tolist()]
+
+    def tolist(self):
+        '''Return all the strings, decoding the bytes at once'''
+        text = bytes(self.data).decode('utf-8')
+        # the chars before each offset, counting the first byte of each
+        chars = np.zeros(len(self.data) + 1, dtype=np.int64)
+        np.cumsum((self.data & 0xC0) != 0x80, out=chars[1:])
+        bounds = chars[self.offsets].tolist()
+        return [text[start:end] for start, end in zip(bounds[:-1],
+                                                      bounds[1:])]
+
+    def search(self, strings):
+        '''Return the positions of "strings", -1 for absent ones'''
+        if self.positions is None:
+            self.positions = {string: pos for pos, string in
+                              enumerate(self.tolist())}
+        positions = self.positions
+        return np.fromiter((positions.get(string, -1) for string in strings),
+                           dtype=np.int64, count=len(strings))
+
+def string_arrays(strings):
+    '''Return the (data, offsets) arrays of StringArray for "strings"'''
+    encoded = [string.encode('utf-8') for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(string) for string in encoded])
+    data = np.frombuffer(b''.join(encoded), dtype=np.uint8)
+    return data, offsets
+
 def read_keyword_dir(dirname, thres=10000):
     '''Load keywords for each document'''
+    return read_keyword_files(walk_all_files(dirname), thres)
+
+def read_keyword_files(files, thres=10000):
+    '''Load keywords of a list of (filename, filepath) of keyterm files'''
     keyword_dict = {}
-    for filename, filepath in walk_all_files(dirname):
+    for filename, filepath in files:
         with open(filepath) as keyfile:
             keyword_dict[filename] = []
             for ind, line in enumerate(keyfile):
@@ -77,7 +294,7 @@ def alias_setup(probs):
     '''
     n = len(probs)
     prob_table = np.zeros(n)
-    alias_table = np.zeros(n, dtype=np.int)
+    alias_table = np.zeros(n, dtype=np.int64)
     smaller = []
     larger = []
     for ind, prob in enumerate(probs):